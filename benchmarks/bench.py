@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Benchmarks against an in-process directory
+
+The directory is served by the ldap3 mock strategies and seeded with
+generated entries, so no LDAP server is needed. The numbers measure the
+overhead of flask-ldapconn and ldap3, not the network or a server.
+
+Usage::
+
+    python benchmarks/bench.py --entries 10000 --save baseline.json
+    python benchmarks/bench.py --entries 10000 --compare baseline.json
+'''
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+from collections import OrderedDict
+
+import flask
+import ldap3
+from ldap3 import MOCK_SYNC, MOCK_ASYNC, NONE, Connection
+
+from flask_ldapconn import LDAPConn
+from flask_ldapconn.entry import LDAPEntry
+from flask_ldapconn.attribute import LdapField
+
+
+BASE_DN = 'dc=example,dc=com'
+PEOPLE_DN = 'ou=people,' + BASE_DN
+BIND_DN = 'cn=admin,' + BASE_DN
+SECRET = 'secret'
+
+
+class User(LDAPEntry):
+
+    __slots__ = ()
+
+    base_dn = PEOPLE_DN
+    object_classes = ['inetOrgPerson']
+    entry_rdn = ['uid']
+
+    name = LdapField('cn')
+    surname = LdapField('sn')
+    userid = LdapField('uid')
+    email = LdapField('mail')
+    title = LdapField('title')
+    groups = LdapField('memberOf')
+
+
+def get_attributes(number):
+    uid = 'user{0}'.format(number)
+    return {
+        'objectClass': ['top', 'person', 'organizationalPerson',
+                        'inetOrgPerson'],
+        'uid': uid,
+        'cn': 'User {0}'.format(number),
+        'sn': str(number),
+        'mail': '{0}@example.com'.format(uid),
+        'title': 'Staff',
+        'memberOf': ['cn=group{0},ou=groups,{1}'.format(group, BASE_DN)
+                     for group in range(number % 5)],
+        'userPassword': uid,
+    }
+
+
+def create_app(entries):
+    '''Return the app and the extension for a directory of ``entries``
+    generated users
+    '''
+    app = flask.Flask(__name__)
+    app.config.update(
+        LDAP_SERVER='localhost',
+        LDAP_USE_TLS=False,
+        LDAP_BINDDN=BIND_DN,
+        LDAP_SECRET=SECRET,
+        LDAP_GET_INFO=NONE,
+        LDAP_CONNECTION_STRATEGY=MOCK_SYNC,
+        LDAP_SESSION_STRATEGY=MOCK_ASYNC,
+    )
+    ldap = LDAPConn(app)
+
+    # All mock connections to a server share its directory
+    conn = Connection(ldap.ldap_server, client_strategy=MOCK_SYNC)
+    conn.strategy.add_entry(BIND_DN, {'objectClass': ['top', 'person'],
+                                      'sn': 'admin',
+                                      'userPassword': SECRET})
+    for number in range(entries):
+        attributes = get_attributes(number)
+        conn.strategy.add_entry('uid={0},{1}'.format(attributes['uid'],
+                                                     PEOPLE_DN),
+                                attributes)
+    return app, ldap
+
+
+def bench_connect(app, ldap, entries):
+    def connect(number):
+        ldap.connect(BIND_DN, SECRET).unbind()
+    return connect
+
+
+def bench_authenticate(app, ldap, entries):
+    def authenticate(number):
+        uid = 'user{0}'.format(number % entries)
+        assert ldap.authenticate(uid, uid, 'uid', PEOPLE_DN)
+    return authenticate
+
+
+def bench_query_get(app, ldap, entries):
+    def query_get(number):
+        dn = 'uid=user{0},{1}'.format(number % entries, PEOPLE_DN)
+        assert User.query.get(dn) is not None
+    return query_get
+
+
+def bench_hydrate(app, ldap, entries):
+    conn = ldap.connection
+    conn.search(PEOPLE_DN, '(objectClass=inetOrgPerson)',
+                attributes=User.query.get_attribute_names())
+    responses = [response for response in conn.response
+                 if response['type'] == 'searchResEntry']
+
+    def hydrate(number):
+        User.from_search_response(responses[number % len(responses)])
+    return hydrate
+
+
+def bench_to_json(app, ldap, entries):
+    users = User.query.all()[:1000]
+
+    def to_json(number):
+        users[number % len(users)].to_json()
+    return to_json
+
+
+def bench_save_add(app, ldap, entries):
+    def save_add(number):
+        uid = 'new{0}'.format(number)
+        user = User(userid=uid, name=uid, surname=uid,
+                    email='{0}@example.com'.format(uid))
+        assert user.save()
+    return save_add
+
+
+def bench_save_modify(app, ldap, entries):
+    users = User.query.all()[:1000]
+
+    def save_modify(number):
+        user = users[number % len(users)]
+        user.title = 'Title {0}'.format(number)
+        assert user.save()
+    return save_modify
+
+
+BENCHMARKS = OrderedDict([
+    ('connect', bench_connect),
+    ('authenticate', bench_authenticate),
+    ('query_get', bench_query_get),
+    ('hydrate', bench_hydrate),
+    ('to_json', bench_to_json),
+    ('save_add', bench_save_add),
+    ('save_modify', bench_save_modify),
+])
+
+
+def get_percentile(timings, percentile):
+    return timings[min(len(timings) - 1, int(len(timings) * percentile))]
+
+
+def run(app, ldap, name, entries, operations, memory_operations):
+    '''Run a benchmark and return its result
+
+    The timings are taken without tracing, the peak memory is measured
+    in a separate traced run of ``memory_operations`` operations.
+    '''
+    with app.test_request_context():
+        operation = BENCHMARKS[name](app, ldap, entries)
+        timings = []
+        for number in range(operations):
+            start = time.perf_counter()
+            operation(number)
+            timings.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        for number in range(memory_operations):
+            operation(operations + number)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    timings.sort()
+    return OrderedDict([
+        ('ops_per_sec', len(timings) / sum(timings)),
+        ('p50_us', get_percentile(timings, 0.50) * 1e6),
+        ('p95_us', get_percentile(timings, 0.95) * 1e6),
+        ('p99_us', get_percentile(timings, 0.99) * 1e6),
+        ('peak_kib', peak / 1024.0),
+    ])
+
+
+def compare(results, baseline, threshold):
+    '''Print the change against a baseline and return the names of the
+    benchmarks whose throughput dropped more than ``threshold``
+    '''
+    regressions = []
+    print('\n{0:<14} {1:>12} {2:>10} {3:>10}'.format(
+        'benchmark', 'baseline/s', 'ops/s', 'p95'))
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        throughput = result['ops_per_sec'] / before['ops_per_sec'] - 1
+        latency = result['p95_us'] / before['p95_us'] - 1
+        print('{0:<14} {1:>12.0f} {2:>+9.1%} {3:>+9.1%}'.format(
+            name, before['ops_per_sec'], throughput, latency))
+        if throughput < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--entries', type=int, default=1000,
+                        help='number of generated entries (default: 1000)')
+    parser.add_argument('--operations', type=int, default=1000,
+                        help='operations per benchmark (default: 1000)')
+    parser.add_argument('--memory-operations', type=int, default=100,
+                        help='traced operations per benchmark to measure '
+                             'the peak memory (default: 100)')
+    parser.add_argument('--only', action='append', choices=list(BENCHMARKS),
+                        help='run only this benchmark, can be repeated')
+    parser.add_argument('--save', metavar='PATH',
+                        help='save the results as baseline')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare the results with a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='throughput drop counted as regression '
+                             '(default: 0.2)')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    app, ldap = create_app(args.entries)
+    seed_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('Seeded {0} entries in {1:.1f}s, peak {2:.0f} KiB'.format(
+        args.entries, time.perf_counter() - start, seed_peak / 1024.0))
+
+    print('\n{0:<14} {1:>10} {2:>10} {3:>10} {4:>10} {5:>10}'.format(
+        'benchmark', 'ops/s', 'p50 us', 'p95 us', 'p99 us', 'peak KiB'))
+    results = OrderedDict()
+    for name in args.only or BENCHMARKS:
+        result = run(app, ldap, name, args.entries, args.operations,
+                     args.memory_operations)
+        results[name] = result
+        print('{0:<14} {ops_per_sec:>10.0f} {p50_us:>10.1f} {p95_us:>10.1f} '
+              '{p99_us:>10.1f} {peak_kib:>10.1f}'.format(name, **result))
+
+    if args.save:
+        with open(args.save, 'w') as baseline:
+            json.dump({
+                'environment': {
+                    'entries': args.entries,
+                    'operations': args.operations,
+                    'python': platform.python_version(),
+                    'ldap3': ldap3.__version__,
+                },
+                'results': results,
+            }, baseline, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            baseline = json.load(baseline)
+        if baseline['environment']['entries'] != args.entries:
+            print('\nThe baseline was run with {0} entries'.format(
+                baseline['environment']['entries']))
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print('\nRegressions: {0}'.format(', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
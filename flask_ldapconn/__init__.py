@@ -1,20 +1,48 @@
 # -*- coding: utf-8 -*-
 import ssl
+import json
+import asyncio
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import current_app, g
-from ldap3 import Server, Connection, Tls
-from ldap3 import SYNC, ALL, SUBTREE
+from ldap3 import Server, Tls
+from ldap3 import SYNC, ASYNC, ALL, NONE, SUBTREE, DsaInfo, SchemaInfo
 from ldap3 import AUTO_BIND_NONE, AUTO_BIND_NO_TLS, AUTO_BIND_TLS_BEFORE_BIND
 from ldap3 import ANONYMOUS, SIMPLE, SASL
+from ldap3 import ROUND_ROBIN
 from ldap3.core.exceptions import (LDAPBindError, LDAPInvalidFilterError,
-                                   LDAPInvalidDnError)
+                                   LDAPInvalidDnError, LDAPCommunicationError,
+                                   LDAPServerPoolError,
+                                   LDAPInvalidCredentialsResult)
 from ldap3.utils.dn import parse_dn
 
 from .entry import LDAPEntry
 from .attribute import LdapField
+from .pool import ConnectionPool
+from .metrics import LDAPMetrics
+from .querylog import LDAPQueryLog
+from .connection import LDAPConnection
+from .serverpool import LDAPServerPool, LATENCY
+from .cache import LRUCache, QueryCache
+from .session import LDAPSession
+from .cli import ldap_cli
 
 
-__all__ = ('LDAPConn',)
+__all__ = ('LDAPConn', 'LAZY', 'LATENCY')
+
+
+# Server info is only read from the server when requested
+LAZY = 'LAZY'
+
+
+def _call_in_app_context(app, func, args, kwargs, credentials=None):
+    with app.app_context():
+        if credentials is not None:
+            ldapc = app.extensions['ldap_conn']
+            g.ldap_conn = ldapc.connect(*credentials)
+        return func(*args, **kwargs)
 
 
 class LDAPConn(object):
@@ -24,6 +52,14 @@ class LDAPConn(object):
         self.Entry = LDAPEntry
         self.Attribute = LdapField
         self.Model = self.Entry
+        self.pool = None
+        self.auth_pool = None
+        self.dn_cache = None
+        self.metrics = None
+        self.query_log = None
+        self.executor = None
+        self._server_info_lock = threading.Lock()
+        self._executor_lock = threading.Lock()
         self.app = app
 
         if app is not None:
@@ -35,6 +71,8 @@ class LDAPConn(object):
         # Default config
         app.config.setdefault('LDAP_SERVER', 'localhost')
         app.config.setdefault('LDAP_PORT', 389)
+        app.config.setdefault('LDAP_SERVER_POOL_STRATEGY', ROUND_ROBIN)
+        app.config.setdefault('LDAP_SERVER_POOL_EJECT_TIME', 30)
         app.config.setdefault('LDAP_BINDDN', None)
         app.config.setdefault('LDAP_SECRET', None)
         app.config.setdefault('LDAP_CONNECT_TIMEOUT', 10)
@@ -42,8 +80,28 @@ class LDAPConn(object):
         app.config.setdefault('LDAP_VALID_NAMES', None)
         app.config.setdefault('LDAP_PRIVATE_KEY_PASSWORD', None)
         app.config.setdefault('LDAP_RAISE_EXCEPTIONS', False)
+        app.config.setdefault('LDAP_GET_INFO', ALL)
+        app.config.setdefault('LDAP_SERVER_INFO_SNAPSHOT', None)
 
         app.config.setdefault('LDAP_CONNECTION_STRATEGY', SYNC)
+        app.config.setdefault('LDAP_SESSION_STRATEGY', ASYNC)
+        app.config.setdefault('LDAP_ASYNC_WORKERS', None)
+
+        app.config.setdefault('LDAP_POOL_SIZE', 0)
+        app.config.setdefault('LDAP_POOL_MAX_OVERFLOW', 10)
+        app.config.setdefault('LDAP_POOL_TIMEOUT', 30)
+        app.config.setdefault('LDAP_POOL_RECYCLE', 600)
+        app.config.setdefault('LDAP_AUTH_POOL_SIZE', 0)
+        app.config.setdefault('LDAP_AUTH_CACHE_SIZE', 0)
+        app.config.setdefault('LDAP_AUTH_CACHE_TTL', 300)
+        app.config.setdefault('LDAP_QUERY_CACHE_SIZE', 1000)
+        app.config.setdefault('LDAP_QUERY_CACHE_BACKEND', None)
+        app.config.setdefault('LDAP_IDENTITY_MAP', False)
+        app.config.setdefault('LDAP_METRICS', False)
+        app.config.setdefault('LDAP_COLLECT_USAGE', False)
+        app.config.setdefault('LDAP_SLOW_QUERY_THRESHOLD', None)
+        app.config.setdefault('LDAP_REPEATED_QUERY_THRESHOLD', None)
+        app.config.setdefault('LDAP_QUERY_LOG_SIZE', 0)
 
         app.config.setdefault('LDAP_USE_SSL', False)
         app.config.setdefault('LDAP_USE_TLS', True)
@@ -71,22 +129,138 @@ class LDAPConn(object):
             local_private_key_password=app.config['LDAP_PRIVATE_KEY_PASSWORD']
         )
 
-        self.ldap_server = Server(
-            host=app.config['LDAP_SERVER'],
+        get_info = app.config['LDAP_GET_INFO']
+        snapshot = app.config['LDAP_SERVER_INFO_SNAPSHOT']
+        if get_info == LAZY or snapshot is not None:
+            get_info = NONE
+
+        hosts = app.config['LDAP_SERVER']
+        if isinstance(hosts, (list, tuple)):
+            if not hosts:
+                raise LDAPServerPoolError('no servers in LDAP_SERVER')
+            self.ldap_server = LDAPServerPool(
+                [self._create_server(app, host, get_info) for host in hosts],
+                pool_strategy=app.config['LDAP_SERVER_POOL_STRATEGY'],
+                eject_time=app.config['LDAP_SERVER_POOL_EJECT_TIME']
+            )
+        else:
+            self.ldap_server = self._create_server(app, hosts, get_info)
+
+        if snapshot is not None:
+            self._load_server_info(snapshot)
+
+        if app.config['LDAP_POOL_SIZE'] > 0:
+            self.pool = ConnectionPool(
+                self._connect_service,
+                size=app.config['LDAP_POOL_SIZE'],
+                max_overflow=app.config['LDAP_POOL_MAX_OVERFLOW'],
+                timeout=app.config['LDAP_POOL_TIMEOUT'],
+                recycle=app.config['LDAP_POOL_RECYCLE']
+            )
+
+        if app.config['LDAP_AUTH_POOL_SIZE'] > 0:
+            self.auth_pool = ConnectionPool(
+                self._connect_service,
+                size=app.config['LDAP_AUTH_POOL_SIZE'],
+                max_overflow=app.config['LDAP_POOL_MAX_OVERFLOW'],
+                timeout=app.config['LDAP_POOL_TIMEOUT'],
+                recycle=app.config['LDAP_POOL_RECYCLE']
+            )
+
+        if app.config['LDAP_AUTH_CACHE_SIZE'] > 0:
+            self.dn_cache = LRUCache(
+                maxsize=app.config['LDAP_AUTH_CACHE_SIZE'],
+                ttl=app.config['LDAP_AUTH_CACHE_TTL']
+            )
+
+        if app.config['LDAP_METRICS']:
+            self.metrics = LDAPMetrics(app)
+
+        slow = app.config['LDAP_SLOW_QUERY_THRESHOLD']
+        repeated = app.config['LDAP_REPEATED_QUERY_THRESHOLD']
+        if slow is not None or repeated is not None:
+            self.query_log = LDAPQueryLog(
+                app, slow=slow, repeated=repeated,
+                max_operations=app.config['LDAP_QUERY_LOG_SIZE']
+            )
+
+        query_cache_backend = app.config['LDAP_QUERY_CACHE_BACKEND']
+        if query_cache_backend is None:
+            query_cache_backend = LRUCache(
+                maxsize=app.config['LDAP_QUERY_CACHE_SIZE'])
+        self.query_cache = QueryCache(query_cache_backend)
+
+        # Store ldap_conn object to extensions
+        app.extensions['ldap_conn'] = self
+
+        # Teardown appcontext
+        app.teardown_appcontext(self.teardown)
+
+        app.cli.add_command(ldap_cli)
+
+    def _create_server(self, app, host, get_info):
+        return Server(
+            host=host,
             port=app.config['LDAP_PORT'],
             use_ssl=app.config['LDAP_USE_SSL'],
             connect_timeout=app.config['LDAP_CONNECT_TIMEOUT'],
             tls=self.tls,
-            get_info=ALL
+            get_info=get_info
         )
 
-        # Store ldap_conn object to extensions
-        app.extensions['ldap_conn'] = self
+    def _get_servers(self):
+        if isinstance(self.ldap_server, LDAPServerPool):
+            return self.ldap_server.servers
+        return [self.ldap_server]
 
-        # Teardown appcontext
-        app.teardown_appcontext(self.teardown)
+    def _load_server_info(self, path):
+        with open(path) as snapshot:
+            definition = json.load(snapshot)
+        schema = SchemaInfo.from_json(json.dumps(definition['schema']))
+        info = DsaInfo.from_json(json.dumps(definition['info']), schema)
+        for server in self._get_servers():
+            server.attach_schema_info(schema)
+            server.attach_dsa_info(info)
+
+    def get_server_info(self):
+        '''Return the DSA info and schema of the LDAP server.
+
+        If the info was neither read at bind time nor loaded from a
+        snapshot, it is read from the server once and kept for the
+        lifetime of the process.
+
+        Returns:
+            tuple: ``(DsaInfo, SchemaInfo)``
+        '''
+        server = self.ldap_server
+        if isinstance(server, LDAPServerPool):
+            server = self.connection.server
+        with self._server_info_lock:
+            if server.info is None or server.schema is None:
+                get_info = server.get_info
+                server.get_info = ALL
+                try:
+                    server.get_info_from_server(self.connection)
+                finally:
+                    server.get_info = get_info
+        return server.info, server.schema
+
+    def save_server_info(self, path):
+        '''Write the DSA info and schema of the LDAP server to a JSON
+        snapshot which can be loaded with ``LDAP_SERVER_INFO_SNAPSHOT``.
 
-    def connect(self, user, password, anonymous=False):
+        Args:
+            path (str): File to write the snapshot to.
+        '''
+        info, schema = self.get_server_info()
+        definition = {
+            'info': json.loads(info.to_json()),
+            'schema': json.loads(schema.to_json()),
+        }
+        with open(path, 'w') as snapshot:
+            json.dump(definition, snapshot, indent=2, sort_keys=True)
+
+    def connect(self, user, password, anonymous=False, client_strategy=None):
         auto_bind_strategy = AUTO_BIND_TLS_BEFORE_BIND
         authentication_policy = SIMPLE
         if current_app.config['LDAP_USE_TLS'] is not True:
@@ -96,34 +270,141 @@ class LDAPConn(object):
             user = None
             password = None
 
-        ldap_conn = Connection(
-            self.ldap_server,
-            auto_bind=auto_bind_strategy,
-            client_strategy=current_app.config['LDAP_CONNECTION_STRATEGY'],
-            raise_exceptions=current_app.config['LDAP_RAISE_EXCEPTIONS'],
-            authentication=authentication_policy,
-            user=user,
-            password=password,
-            check_names=True,
-            read_only=current_app.config['LDAP_READ_ONLY'],
-        )
+        if client_strategy is None:
+            client_strategy = current_app.config['LDAP_CONNECTION_STRATEGY']
+
+        # Fail over to the other servers of a pool, the failed servers
+        # are ejected from the pool
+        attempts = len(self._get_servers())
+        for attempt in range(attempts):
+            try:
+                ldap_conn = LDAPConnection(
+                    self.ldap_server,
+                    auto_bind=auto_bind_strategy,
+                    client_strategy=client_strategy,
+                    raise_exceptions=current_app.config[
+                        'LDAP_RAISE_EXCEPTIONS'],
+                    authentication=authentication_policy,
+                    user=user,
+                    password=password,
+                    check_names=True,
+                    read_only=current_app.config['LDAP_READ_ONLY'],
+                    collect_usage=current_app.config['LDAP_COLLECT_USAGE'],
+                )
+                break
+            except LDAPCommunicationError:
+                if attempt == attempts - 1:
+                    raise
+
+        # ldap3 skips the automatic bind for the mock strategies
+        if ldap_conn.strategy.no_real_dsa and not ldap_conn.bound:
+            ldap_conn.open(read_server_info=False)
+            if not ldap_conn.bind():
+                ldap_conn.unbind()
+                raise LDAPBindError('automatic bind not successful')
 
         return ldap_conn
 
+    @staticmethod
+    def _service_is_anonymous():
+        return None in [current_app.config['LDAP_BINDDN'],
+                        current_app.config['LDAP_SECRET']]
+
+    def _connect_service(self, client_strategy=None):
+        return self.connect(
+            current_app.config['LDAP_BINDDN'],
+            current_app.config['LDAP_SECRET'],
+            anonymous=self._service_is_anonymous(),
+            client_strategy=client_strategy
+        )
+
+    def connect_session(self):
+        '''Return a new connection for pipelined requests
+
+        The connection is bound with the credentials of ``g.ldap_conn``
+        if it is bound as a user (see "Bind as user"), else as the
+        service account.
+        '''
+        client_strategy = current_app.config['LDAP_SESSION_STRATEGY']
+        credentials = self._get_user_credentials()
+        if credentials is not None:
+            user, password, anonymous = credentials
+            return self.connect(user, password, anonymous, client_strategy)
+        return self._connect_service(client_strategy)
+
+    def _get_user_credentials(self):
+        '''Return ``(user, password, anonymous)`` of ``g.ldap_conn`` or
+        ``None`` if it is not bound as another user than the service
+        account.
+        '''
+        ldap_conn = g.get('ldap_conn')
+        if ldap_conn is None or self._is_service_bound(ldap_conn):
+            return None
+        return (ldap_conn.user, ldap_conn.password,
+                ldap_conn.authentication == ANONYMOUS)
+
+    def session(self):
+        '''Return a session to save and delete entries in one go.
+
+        See :class:`flask_ldapconn.session.LDAPSession`.
+        '''
+        return LDAPSession(self)
+
+    def _is_service_bound(self, conn):
+        if not conn.bound:
+            return False
+        if self._service_is_anonymous():
+            return conn.authentication == ANONYMOUS
+        return conn.authentication == SIMPLE and \
+            conn.user == current_app.config['LDAP_BINDDN']
+
     def teardown(self, exception):
-        if 'ldap_conn' in g:
-            g.ldap_conn.unbind()
+        g.pop('ldap_identity_map', None)
+        ldap_conn = g.pop('ldap_conn', None)
+        pooled_conn = g.pop('ldap_pooled_conn', None)
+
+        if pooled_conn is not None:
+            # Never hand out a connection that was rebound to another user
+            if self._is_service_bound(pooled_conn):
+                self.pool.checkin(pooled_conn)
+            else:
+                self.pool.discard(pooled_conn)
+
+        if ldap_conn is not None and ldap_conn is not pooled_conn:
+            ldap_conn.unbind()
 
     @property
     def connection(self):
         if not 'ldap_conn' in g:
-            g.ldap_conn = self.connect(
-                    current_app.config['LDAP_BINDDN'],
-                    current_app.config['LDAP_SECRET'],
-                    anonymous=None in [current_app.config['LDAP_BINDDN'], current_app.config['LDAP_SECRET']]
-                )
+            if self.pool is not None:
+                g.ldap_conn = g.ldap_pooled_conn = self.pool.checkout()
+            else:
+                g.ldap_conn = self._connect_service()
         return g.ldap_conn
 
+    @property
+    def bind_identity(self):
+        '''``(authentication, user)`` of the connection of the current
+        app context, without opening it.
+        '''
+        ldap_conn = g.get('ldap_conn')
+        if ldap_conn is not None:
+            return ldap_conn.authentication, ldap_conn.user
+        if self._service_is_anonymous():
+            return ANONYMOUS, None
+        return SIMPLE, current_app.config['LDAP_BINDDN']
+
+    @property
+    def identity_map(self):
+        '''Entries loaded in the current app context by (model class,
+        normalized DN) or ``None`` if LDAP_IDENTITY_MAP is disabled.
+        '''
+        if not current_app.config['LDAP_IDENTITY_MAP']:
+            return None
+        if 'ldap_identity_map' not in g:
+            g.ldap_identity_map = {}
+        return g.ldap_identity_map
+
     def authenticate(self,
                      username,
                      password,
@@ -155,25 +436,133 @@ class LDAPConn(object):
         except LDAPInvalidDnError:
             pass
 
-        if valid_dn is False:
-            user_filter = '({0}={1})'.format(attribute, username)
-            if search_filter is not None:
-                user_filter = '(&{0}{1})'.format(user_filter, search_filter)
+        if valid_dn is True:
+            return self._bind(username, password)
+
+        search_args = (attribute, username, base_dn, search_filter,
+                       search_scope)
+
+        if self.dn_cache is not None:
+            cached_dn = self.dn_cache.get(search_args)
+            if cached_dn is not None:
+                if self._bind(cached_dn, password):
+                    return True
+                # The entry may have been moved or renamed, look it up
+                # again before rejecting the credentials.
+                user_dn = self._find_user_dn(*search_args)
+                if user_dn == cached_dn:
+                    return False
+                if user_dn is None:
+                    self.dn_cache.delete(search_args)
+                    return False
+                self.dn_cache.set(search_args, user_dn)
+                return self._bind(user_dn, password)
+
+        user_dn = self._find_user_dn(*search_args)
+        if user_dn is None:
+            return False
+        if self.dn_cache is not None:
+            self.dn_cache.set(search_args, user_dn)
+        return self._bind(user_dn, password)
+
+    def _find_user_dn(self, attribute, username, base_dn, search_filter,
+                      search_scope):
+        user_filter = '({0}={1})'.format(attribute, username)
+        if search_filter is not None:
+            user_filter = '(&{0}{1})'.format(user_filter, search_filter)
 
+        try:
+            self.connection.search(base_dn, user_filter, search_scope,
+                                   attributes=[attribute])
+            response = self.connection.response
+            return response[0]['dn']
+        except (LDAPInvalidDnError, LDAPInvalidFilterError, IndexError):
+            return None
+
+    def _bind(self, user, password):
+        # An empty password would be an unauthenticated bind and pooled
+        # connections would rebind with the last password instead
+        if not user or not password:
+            return False
+
+        if self.auth_pool is None:
             try:
-                self.connection.search(base_dn, user_filter, search_scope,
-                                       attributes=[attribute])
-                response = self.connection.response
-                username = response[0]['dn']
-            except (LDAPInvalidDnError, LDAPInvalidFilterError, IndexError):
+                conn = self.connect(user, password)
+                conn.unbind()
+                return True
+            except LDAPBindError:
                 return False
 
+        # Connections in the authentication pool are only used to test
+        # credentials, so they are rebound per attempt and never handed
+        # out for other operations.
+        return self._rebind(user, password)
+
+    def _rebind(self, user, password, retry=True):
+        conn = self.auth_pool.checkout()
+        bound = None
         try:
-            conn = self.connect(username, password)
-            conn.unbind()
-            return True
+            bound = conn.rebind(user, password, read_server_info=False)
+            if not bound and (conn.closed or not conn.result):
+                bound = None
+        except LDAPInvalidCredentialsResult:
+            bound = False
         except LDAPBindError:
-            return False
+            # ldap3 raises it when the server closed the connection
+            pass
+        except LDAPCommunicationError:
+            if not retry:
+                raise
+        finally:
+            # Don't keep the credentials of the user in the pool
+            conn.user = None
+            conn.password = None
+            if bound is None:
+                self.auth_pool.discard(conn)
+            else:
+                self.auth_pool.checkin(conn)
+
+        # The connection may have been dropped while idle, only reject
+        # the credentials after trying a new connection
+        if bound is None and retry:
+            return self._rebind(user, password, retry=False)
+        return bool(bound)
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=current_app.config['LDAP_ASYNC_WORKERS'])
+            return self.executor
+
+    async def run_async(self, func, *args, **kwargs):
+        '''Run a blocking function in the executor of the extension.
+
+        The function runs in a new app context of the current app, so
+        it uses its own connection which is released when it returns.
+        If ``g.ldap_conn`` of the calling app context is bound as
+        another user than the service account, the new connection is
+        bound with the same credentials. Coroutines running outside of
+        a request have to push an app context first.
+
+        Args:
+            func (callable): The function to run.
+            *args: Positional arguments for ``func``.
+            **kwargs: Keyword arguments for ``func``.
+        '''
+        app = current_app._get_current_object()
+        # Bind as the user of the caller, see "Bind as user"
+        credentials = self._get_user_credentials()
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._get_executor(),
+            functools.partial(_call_in_app_context, app, func, args, kwargs,
+                              credentials)
+        )
+
+    async def authenticate_async(self, *args, **kwargs):
+        '''Awaitable version of :meth:`authenticate`'''
+        return await self.run_async(self.authenticate, *args, **kwargs)
 
     def whoami(self):
         '''Deprecated
@@ -1,20 +1,82 @@
 # -*- coding: utf-8 -*-
 
-from flask import current_app
+from flask import current_app, has_app_context
 
 from ldap3 import AttrDef
 from ldap3.core.exceptions import LDAPAttributeError
-from ldap3 import (STRING_TYPES, NUMERIC_TYPES, MODIFY_ADD, MODIFY_DELETE,
-                   MODIFY_REPLACE)
+from ldap3 import (STRING_TYPES, NUMERIC_TYPES, SEQUENCE_TYPES, MODIFY_ADD,
+                   MODIFY_DELETE, MODIFY_REPLACE)
+
+from .expression import Comparison, Or, Not
+
+
+_setattr = object.__setattr__
+
+
+def force_attribute_value_as_list():
+    '''Return the FORCE_ATTRIBUTE_VALUE_AS_LIST setting of the current
+    app or ``False`` outside of an app context.
+    '''
+    if has_app_context():
+        return current_app.config.get('FORCE_ATTRIBUTE_VALUE_AS_LIST',
+                                      False) is not False
+    return False
 
 
 class LdapField(object):
 
-    def __init__(self, name, validate=None, default=None, dereference_dn=None):
+    def __init__(self, name, validate=None, default=None, dereference_dn=None,
+                 ranged=False):
         self.name = name
         self.validate = validate
         self.default = default
         self.dereference_dn = None
+        # Large attributes the server returns in ranges, like member in
+        # Active Directory, are deferred and streamed on demand
+        self.ranged = ranged
+
+    # Comparisons build filter expressions, keep fields hashable
+    __hash__ = object.__hash__
+
+    def __eq__(self, value):
+        if value is None:
+            return Not(Comparison(self.name))
+        return Comparison(self.name, '=', value)
+
+    def __ne__(self, value):
+        return ~(self == value)
+
+    def __ge__(self, value):
+        return Comparison(self.name, '>=', value)
+
+    def __le__(self, value):
+        return Comparison(self.name, '<=', value)
+
+    def present(self):
+        '''Match entries with any value of the attribute'''
+        return Comparison(self.name)
+
+    def startswith(self, value):
+        return Comparison(self.name, '=', value, prefix=True)
+
+    def endswith(self, value):
+        return Comparison(self.name, '=', value, suffix=True)
+
+    def contains(self, value):
+        return Comparison(self.name, '=', value, prefix=True, suffix=True)
+
+    def approx(self, value):
+        return Comparison(self.name, '~=', value)
+
+    def in_(self, values):
+        '''Match entries with any of the given values'''
+        return Or(*[Comparison(self.name, '=', value) for value in values])
+
+    def get_default_values(self):
+        '''Return the values of an attribute missing in a search result'''
+        if isinstance(self.default, SEQUENCE_TYPES):
+            return list(self.default)
+        return [self.default]
 
     def get_abstract_attr_def(self, key):
         return AttrDef(name=self.name, key=key,
@@ -25,10 +87,38 @@ class LdapField(object):
 
 class LDAPAttribute(object):
 
-    def __init__(self, name):
-        self.__dict__['name'] = name
-        self.__dict__['values'] = []
-        self.__dict__['changetype'] = None
+    __slots__ = ('name', 'values', '_changetype', '_force_list', '_original')
+
+    def __init__(self, name, force_list=False):
+        _setattr(self, 'name', name)
+        _setattr(self, 'values', [])
+        _setattr(self, '_changetype', None)
+        _setattr(self, '_force_list', force_list)
+        _setattr(self, '_original', None)
+
+    @classmethod
+    def from_values(cls, name, values, force_list=False, loaded=True):
+        '''Create an attribute with values loaded from the server
+
+        The values are stored as they are, without changetype tracking.
+        Changes to ``loaded`` values are saved as minimal modifications,
+        see :meth:`get_changes`.
+        '''
+        attr = cls.__new__(cls)
+        _setattr(attr, 'name', name)
+        _setattr(attr, 'values', values)
+        _setattr(attr, '_changetype', None)
+        _setattr(attr, '_force_list', force_list)
+        _setattr(attr, '_original', tuple(values) if loaded else None)
+        return attr
+
+    def __getstate__(self):
+        return tuple(getattr(self, key) for key in self.__slots__)
+
+    def __setstate__(self, state):
+        # Slots are restored with setattr, which is guarded
+        for key, value in zip(self.__slots__, state):
+            _setattr(self, key, value)
 
     def __str__(self):
         if isinstance(self.value, STRING_TYPES):
@@ -43,7 +133,7 @@ class LDAPAttribute(object):
         return self.values.__iter__()
 
     def __contains__(self, item):
-        return item in self.__dict__['values']
+        return item in self.values
 
     def __setattr__(self, item, value):
         if item not in ['value', '_init']:
@@ -51,44 +141,92 @@ class LDAPAttribute(object):
 
         # set changetype
         if item == 'value':
-            if self.__dict__['values']:
+            if self.values:
                 if not value:
-                    self.__dict__['changetype'] = MODIFY_DELETE
+                    _setattr(self, '_changetype', MODIFY_DELETE)
                 else:
-                    self.__dict__['changetype'] = MODIFY_REPLACE
+                    _setattr(self, '_changetype', MODIFY_REPLACE)
             else:
-                self.__dict__['changetype'] = MODIFY_ADD
+                _setattr(self, '_changetype', MODIFY_ADD)
 
         if isinstance(value, (STRING_TYPES, NUMERIC_TYPES)):
             value = [value]
 
-        self.__dict__['values'] = value
+        _setattr(self, 'values', value)
 
     @property
     def value(self):
         '''Return single value or list of values from the attribute.
-           If FORCE_ATTRIBUTE_VALUE_AS_LIST is True, always return a
-           list with values.
+           If FORCE_ATTRIBUTE_VALUE_AS_LIST was True when the attribute
+           was created, always return a list with values.
         '''
-        if len(self.__dict__['values']) == 1 and current_app.config['FORCE_ATTRIBUTE_VALUE_AS_LIST'] is False:
-            return self.__dict__['values'][0]
+        if len(self.values) == 1 and not self._force_list:
+            return self.values[0]
         else:
-            return self.__dict__['values']
+            return self.values
 
     @property
     def changetype(self):
-        return self.__dict__['changetype']
+        return self._changetype
+
+    def reset_changetype(self):
+        '''Mark the current values as unchanged'''
+        _setattr(self, '_changetype', None)
+        _setattr(self, '_original', tuple(self.values))
+
+    def replace(self):
+        '''Replace all values of the attribute on the server when saved'''
+        _setattr(self, '_changetype', MODIFY_REPLACE)
+        _setattr(self, '_original', None)
+
+    @staticmethod
+    def _encode(values):
+        return [val.encode('UTF-8') if isinstance(val, STRING_TYPES)
+                else val for val in values]
 
     def get_changes_tuple(self):
-        values = [val.encode('UTF-8') for val in self.__dict__['values']]
-        return (self.changetype, values)
+        return (self.changetype, self._encode(self.values))
+
+    def get_changes(self):
+        '''Return the list of ``(changetype, values)`` modifications to
+        save the attribute
+
+        Changes to values loaded from the server are sent as added and
+        deleted values if these are fewer than all values, so adding a
+        value to a large attribute does not replace all of its values.
+        '''
+        if self._changetype is None:
+            return []
+        original = self._original
+        if not original or not self.values:
+            return [self.get_changes_tuple()]
+
+        current = set(self.values)
+        loaded = set(original)
+        added = [val for val in self.values if val not in loaded]
+        deleted = [val for val in original if val not in current]
+        if not added and not deleted:
+            return []
+        if len(added) + len(deleted) >= len(self.values):
+            return [(MODIFY_REPLACE, self._encode(self.values))]
+
+        # Delete first, an added value may equal a deleted one under
+        # the matching rule of the attribute
+        changes = []
+        if deleted:
+            changes.append((MODIFY_DELETE, self._encode(deleted)))
+        if added:
+            changes.append((MODIFY_ADD, self._encode(added)))
+        return changes
 
     def append(self, value):
         '''Add another value to the attribute'''
-        if self.__dict__['values']:
-            self.__dict__['changetype'] = MODIFY_REPLACE
+        if self.values:
+            _setattr(self, '_changetype', MODIFY_REPLACE)
+        else:
+            _setattr(self, '_changetype', MODIFY_ADD)
 
-        self.__dict__['values'].append(value)
+        self.values.append(value)
 
     def delete(self):
         '''Delete this attribute
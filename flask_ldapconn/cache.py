@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict
+from time import monotonic
+from uuid import uuid4
+
+from ldap3.core.exceptions import LDAPInvalidDnError
+from ldap3.utils.dn import parse_dn, safe_dn
+
+
+__all__ = ('BaseCache', 'LRUCache', 'QueryCache')
+
+
+def normalize_dn(dn):
+    '''Return a DN in a form suitable to compare it with other DNs'''
+    if not dn:
+        return ''
+    try:
+        return safe_dn(dn).lower()
+    except LDAPInvalidDnError:
+        return dn.lower()
+
+
+def split_rdns(dn):
+    '''Return the RDNs of a normalized DN'''
+    rdns = []
+    rdn = []
+    try:
+        components = parse_dn(dn, escape=True)
+    except LDAPInvalidDnError:
+        return [dn]
+    for attr, value, separator in components:
+        rdn.append('{0}={1}'.format(attr, value))
+        if separator != '+':
+            rdns.append('+'.join(rdn))
+            rdn = []
+    return rdns
+
+
+class BaseCache(object):
+    '''Interface of a cache backend
+
+    Backends shared between processes must be able to store picklable
+    values under string keys.
+    '''
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LRUCache(BaseCache):
+    '''A bounded, thread-safe in-process cache with time-to-live.
+
+    The least recently used key is dropped once ``maxsize`` is reached.
+
+    Args:
+        maxsize (int): Maximum number of keys to keep.
+        ttl (int): Default seconds until a key expires. ``None`` keeps
+            keys until they are evicted.
+    '''
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class QueryCache(object):
+    '''Stores query results in a cache backend
+
+    Every DN has a generation token in the backend which is part of the
+    key of all queries using this DN as base. Changing an entry renews
+    the tokens of the entry and all its parents, so cached results of
+    queries below the changed entry are not used anymore.
+
+    Args:
+        backend (BaseCache): Cache backend to store the results in.
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _generation(self, dn):
+        key = 'flask_ldapconn:generation:{0}'.format(dn)
+        generation = self.backend.get(key)
+        if generation is None:
+            generation = uuid4().hex
+            self.backend.set(key, generation)
+        return generation
+
+    def make_key(self, base_dn, *args):
+        '''Return the cache key of a query below ``base_dn``'''
+        base_dn = normalize_dn(base_dn)
+        return 'flask_ldapconn:query:{0}'.format(
+            repr((base_dn, self._generation(base_dn)) + args))
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, result, ttl=None):
+        self.backend.set(key, result, ttl)
+
+    def invalidate(self, dn):
+        '''Drop the cached results of all queries which may contain the
+        entry ``dn``
+        '''
+        rdns = split_rdns(normalize_dn(dn))
+        for index in range(len(rdns)):
+            key = 'flask_ldapconn:generation:{0}'.format(
+                ','.join(rdns[index:]))
+            self.backend.set(key, uuid4().hex)
+
+    def clear(self):
+        self.backend.clear()
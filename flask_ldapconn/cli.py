@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import json
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from ldap3 import ALL_ATTRIBUTES, BASE, LEVEL, SUBTREE
+from ldap3.core.exceptions import LDAPLDIFError
+from ldap3.utils.conv import json_hook
+
+from .ldif import entry_to_ldif, parse_ldif
+from .query import _dump_json
+from .session import pipeline
+
+
+__all__ = ('ldap_cli',)
+
+
+ldap_cli = AppGroup('ldap', help='Commands for the LDAP server.')
+
+
+_SCOPES = {'base': BASE, 'one': LEVEL, 'sub': SUBTREE}
+
+
+def _get_format(file, file_format):
+    if file_format is not None:
+        return file_format
+    name = getattr(file, 'name', '')
+    if name.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    return 'ldif'
+
+
+def _parse_ndjson(lines):
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        record = json.loads(line, object_hook=json_hook)
+        yield number, 'add', (record['dn'], None, record['attributes'])
+
+
+@ldap_cli.command('snapshot')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+def snapshot(path):
+    '''Save the server info and schema to a JSON file.'''
+    ldap = current_app.extensions['ldap_conn']
+    ldap.save_server_info(path)
+    click.echo('Server info written to {0}'.format(path))
+
+
+@ldap_cli.command('export')
+@click.argument('base_dn')
+@click.argument('file', type=click.File('w', encoding='utf-8'))
+@click.option('--format', 'file_format', type=click.Choice(['ldif', 'ndjson']),
+              help='Output format, guessed from the file name by default.')
+@click.option('--filter', 'search_filter', default='(objectClass=*)',
+              show_default=True, help='Search filter.')
+@click.option('--scope', type=click.Choice(sorted(_SCOPES)), default='sub',
+              show_default=True, help='Search scope.')
+@click.option('--attribute', '-a', 'attributes', multiple=True,
+              help='Attribute to export, all by default.')
+@click.option('--page-size', default=1000, show_default=True,
+              help='Number of entries per search page.')
+def export(base_dn, file, file_format, search_filter, scope, attributes,
+           page_size):
+    '''Write the entries below BASE_DN to FILE as LDIF or NDJSON.
+
+    The entries are read with a paged search and written one by one.
+    Use - as FILE to write to stdout.
+    '''
+    ldap = current_app.extensions['ldap_conn']
+    file_format = _get_format(file, file_format)
+    responses = ldap.connection.extend.standard.paged_search(
+        search_base=base_dn,
+        search_filter=search_filter,
+        search_scope=_SCOPES[scope],
+        attributes=list(attributes) or ALL_ATTRIBUTES,
+        paged_size=page_size,
+        generator=True)
+
+    if file_format == 'ldif':
+        file.write('version: 1\n\n')
+    count = 0
+    for response in responses:
+        if response['type'] != 'searchResEntry':
+            continue
+        if file_format == 'ldif':
+            file.write(entry_to_ldif(response))
+        else:
+            record = {'dn': response['dn'],
+                      'attributes': response['raw_attributes']}
+            file.write(_dump_json(record).decode('utf-8') + '\n')
+        count += 1
+    click.echo('{0} entries exported'.format(count), err=True)
+
+
+@ldap_cli.command('import')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'file_format', type=click.Choice(['ldif', 'ndjson']),
+              help='Input format, guessed from the file name by default.')
+@click.option('--concurrency', default=10, show_default=True,
+              help='Number of requests sent without waiting for their '
+                   'responses.')
+@click.option('--journal', type=click.File('w', encoding='utf-8'),
+              help='Write the failed records as NDJSON to this file.')
+def import_records(file, file_format, concurrency, journal):
+    '''Add, modify or delete the entries of an LDIF or NDJSON FILE.
+
+    LDIF records are applied according to their changetype, NDJSON
+    records in the format written by the export command are added.
+    The records are pipelined over one connection, failed records do
+    not stop the import and are listed in the journal. Use - as FILE to
+    read from stdin.
+    '''
+    ldap = current_app.extensions['ldap_conn']
+    if _get_format(file, file_format) == 'ldif':
+        records = parse_ldif(file)
+    else:
+        records = _parse_ndjson(file)
+
+    requests = (((number, args[0]), operation, args)
+                for number, operation, args in records)
+    imported = failed = 0
+    conn = ldap.connect_session()
+    try:
+        for (number, dn), operation, result in pipeline(conn, requests,
+                                                        concurrency):
+            if result['result'] == 0:
+                imported += 1
+                continue
+            failed += 1
+            if journal is not None:
+                journal.write(_dump_json({
+                    'line': number,
+                    'operation': operation,
+                    'dn': dn,
+                    'result': result['result'],
+                    'description': result['description'],
+                    'message': result['message'],
+                }).decode('utf-8') + '\n')
+    except (LDAPLDIFError, ValueError, KeyError) as e:
+        raise click.ClickException('Invalid record: {0}'.format(e))
+    finally:
+        conn.unbind()
+
+    click.echo('{0} records imported, {1} failed'.format(imported, failed),
+               err=True)
+    if failed:
+        click.get_current_context().exit(1)
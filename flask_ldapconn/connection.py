@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+from timeit import default_timer
+
+from ldap3 import Connection, SUBTREE
+from ldap3.core.exceptions import LDAPCommunicationError
+
+from .signals import is_observed, send_operation
+from .serverpool import LDAPServerPool
+
+
+__all__ = ('LDAPConnection',)
+
+
+def _get_arg(args, kwargs, index, name, default=None):
+    if len(args) > index:
+        return args[index]
+    return kwargs.get(name, default)
+
+
+class LDAPConnection(Connection):
+    '''ldap3 connection which sends the ``ldap_operation`` signal
+
+    Operations are timed when the signal has receivers only. With an
+    asynchronous strategy the operations return before the response
+    arrived, so only binds are timed here and pipelined requests are
+    timed by :func:`flask_ldapconn.session.pipeline`.
+
+    With a :class:`flask_ldapconn.serverpool.LDAPServerPool` the
+    response times and communication errors are reported to the pool.
+    '''
+
+    def __init__(self, server, *args, **kwargs):
+        try:
+            super(LDAPConnection, self).__init__(server, *args, **kwargs)
+        except LDAPCommunicationError:
+            # Opening the socket for the automatic bind failed
+            if isinstance(server, LDAPServerPool) and self.server:
+                server.report_failure(self.server)
+            raise
+
+    def _observe(self, operation, method, dn, args, kwargs,
+                 search_filter=None, scope=None):
+        pool = self.server_pool
+        if not isinstance(pool, LDAPServerPool):
+            pool = None
+        observed = is_observed()
+        if not (observed or pool) or \
+                not (self.strategy.sync or operation == 'bind'):
+            return method(self, *args, **kwargs)
+
+        usage = self._usage
+        size = None
+        if usage is not None:
+            size = usage.bytes_transmitted + usage.bytes_received
+        returned = None
+        start = default_timer()
+        try:
+            returned = method(self, *args, **kwargs)
+            return returned
+        except LDAPCommunicationError:
+            if pool is not None:
+                pool.report_failure(self.server)
+                pool = None
+            raise
+        finally:
+            duration = default_timer() - start
+            if pool is not None:
+                pool.report_latency(self.server, duration)
+            if observed:
+                if usage is not None:
+                    size = usage.bytes_transmitted + usage.bytes_received - \
+                        size
+                self._send_operation(operation, dn, duration, returned, size,
+                                     search_filter, scope)
+
+    def _send_operation(self, operation, dn, duration, returned, size,
+                        search_filter, scope):
+        count = None
+        if operation == 'search':
+            # Thread safe strategies return the response instead of
+            # storing it on the connection
+            if isinstance(returned, tuple):
+                response = returned[2]
+            else:
+                response = self.response
+            count = len([entry for entry in response or ()
+                         if entry['type'] == 'searchResEntry'])
+        result = self.result.get('result') if self.result else None
+        # Asynchronous strategies don't store the bind result
+        if result is None and operation == 'bind' and returned:
+            result = 0
+        send_operation(operation, dn, duration, result,
+                       search_filter=search_filter, scope=scope,
+                       count=count, size=size)
+
+    def bind(self, *args, **kwargs):
+        return self._observe('bind', Connection.bind, self.user, args,
+                             kwargs)
+
+    def search(self, *args, **kwargs):
+        return self._observe(
+            'search', Connection.search,
+            _get_arg(args, kwargs, 0, 'search_base'), args, kwargs,
+            search_filter=_get_arg(args, kwargs, 1, 'search_filter'),
+            scope=_get_arg(args, kwargs, 2, 'search_scope', SUBTREE))
+
+    def add(self, *args, **kwargs):
+        return self._observe('add', Connection.add,
+                             _get_arg(args, kwargs, 0, 'dn'), args, kwargs)
+
+    def modify(self, *args, **kwargs):
+        return self._observe('modify', Connection.modify,
+                             _get_arg(args, kwargs, 0, 'dn'), args, kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._observe('delete', Connection.delete,
+                             _get_arg(args, kwargs, 0, 'dn'), args, kwargs)
+
+    def modify_dn(self, *args, **kwargs):
+        return self._observe('modify_dn', Connection.modify_dn,
+                             _get_arg(args, kwargs, 0, 'dn'), args, kwargs)
+
+    def compare(self, *args, **kwargs):
+        return self._observe('compare', Connection.compare,
+                             _get_arg(args, kwargs, 0, 'dn'), args, kwargs)
@@ -1,17 +1,40 @@
 # -*- coding: utf-8 -*-
 import json
 from flask import current_app
+from ldap3 import BASE, ObjectDef
+from ldap3.utils.ciDict import CaseInsensitiveDict
 from ldap3.utils.dn import safe_dn
 from ldap3.utils.conv import check_json_dict, format_json
 from ldap3.core.exceptions import LDAPAttributeError
 
 from .query import BaseQuery
-from .attribute import LDAPAttribute, LdapField
+from .cache import normalize_dn
+from .attribute import (LDAPAttribute, LdapField,
+                        force_attribute_value_as_list)
 
 
 __all__ = ('LDAPEntry',)
 
 
+def _get_range(attributes, name):
+    '''Return the values of attribute ``name`` in a search response and
+    the attribute description to request the next range with or
+    ``None`` if all values were returned.
+    '''
+    name = name.lower()
+    prefix = name + ';range='
+    for key, values in attributes.items():
+        key = key.lower()
+        if key == name:
+            return values, None
+        if key.startswith(prefix):
+            high = key[len(prefix):].partition('-')[2]
+            if high == '*':
+                return values, None
+            return values, '{0}{1}-*'.format(prefix, int(high) + 1)
+    return [], None
+
+
 class LDAPEntryMeta(type):
 
     def __init__(cls, name, bases, attr):
@@ -27,6 +50,42 @@ class LDAPEntryMeta(type):
                 cls.object_classes = list(
                     set(cls.object_classes + base.object_classes))
 
+        cls._object_def = None
+        cls._attribute_names = [field.name for field in cls._fields.values()]
+        # Ranged fields are not loaded by default
+        ranged = [key for key, field in cls._fields.items() if field.ranged]
+        if ranged:
+            cls._default_fields = tuple(sorted(set(cls._fields) - set(ranged)))
+        else:
+            cls._default_fields = None
+
+    def get_object_def(cls):
+        '''Return the ObjectDef with the fields of the model
+
+        The definition is compiled on first use and shared by all
+        queries of the model class.
+        '''
+        object_def = cls._object_def
+        if object_def is None:
+            object_def = ObjectDef(cls.object_classes)
+            for key, field in cls._fields.items():
+                object_def.add_attribute(field.get_abstract_attr_def(key))
+            cls._object_def = object_def
+        return object_def
+
+    def get_object_class_filter(cls):
+        '''Return the LDAP filter matching the object classes of the
+        model
+        '''
+        object_classes = cls.get_object_def()._object_class
+        if not object_classes:
+            return '(objectClass=*)'
+        if len(object_classes) == 1:
+            return '(objectClass={0})'.format(object_classes[0])
+        return '(&{0})'.format(''.join(
+            '(objectClass={0})'.format(object_class)
+            for object_class in object_classes))
+
     @property
     def query(cls):
         return BaseQuery(cls)
@@ -34,17 +93,21 @@ class LDAPEntryMeta(type):
 
 class LDAPEntry(object, metaclass=LDAPEntryMeta):
 
+    __slots__ = ('_attributes', '_dn', '_changetype', '_force_list',
+                 '_deferred')
+
     base_dn = None
     entry_rdn = ['cn']
     object_classes = ['top']
     sub_tree = True
     operational_attributes = False
-    _changetype = 'add'
 
     def __init__(self, dn=None, changetype='add', **kwargs):
         self._attributes = {}
         self._dn = dn
         self._changetype = changetype
+        self._force_list = force_attribute_value_as_list()
+        self._deferred = frozenset()
         if kwargs:
             for key, value in kwargs.items():
                 self._store_attr(key, value, init=True)
@@ -52,6 +115,105 @@ class LDAPEntry(object, metaclass=LDAPEntryMeta):
             if not self._isstored(key):
                 self._store_attr(key, [])
 
+    @classmethod
+    def from_search_response(cls, response, force_list=None, fields=None):
+        '''Create an entry from an ldap3 search response
+
+        The attribute values of the response are loaded into the entry
+        without changetype tracking, fields missing in the response get
+        their default value.
+
+        Args:
+            response (dict): A ``searchResEntry`` from
+                ``Connection.response``
+            force_list (bool): Always return attribute values as list,
+                defaults to the FORCE_ATTRIBUTE_VALUE_AS_LIST setting
+            fields (list): Keys of the fields requested in the search,
+                the other fields are deferred. Defaults to all fields.
+        '''
+        if force_list is None:
+            force_list = force_attribute_value_as_list()
+        attributes = response['attributes']
+        raw_attributes = response['raw_attributes']
+        if not isinstance(raw_attributes, CaseInsensitiveDict):
+            attributes = CaseInsensitiveDict(attributes)
+            raw_attributes = CaseInsensitiveDict(raw_attributes)
+
+        if fields is None:
+            field_items = cls._fields.items()
+        else:
+            field_items = [(key, cls._fields[key]) for key in fields]
+
+        values = {}
+        for key, field in field_items:
+            name = field.name
+            if raw_attributes.get(name):
+                attr_values = attributes[name]
+                if not isinstance(attr_values, list):
+                    attr_values = [attr_values]
+            else:
+                attr_values = field.get_default_values()
+            values[key] = attr_values
+
+        return cls.from_attributes_dict(response['dn'], values, force_list)
+
+    @classmethod
+    def from_attributes_dict(cls, dn, attributes, force_list=None):
+        '''Create an entry with attribute values loaded from the server
+
+        Fields missing in ``attributes`` are deferred.
+
+        Args:
+            dn (str): DN of the entry
+            attributes (dict): Lists of values by field name as returned
+                by ``get_attributes_dict()``
+            force_list (bool): Always return attribute values as list,
+                defaults to the FORCE_ATTRIBUTE_VALUE_AS_LIST setting
+        '''
+        if force_list is None:
+            force_list = force_attribute_value_as_list()
+
+        entry_attributes = {}
+        for key, values in attributes.items():
+            field = cls._fields[key]
+            # Defaults of attributes missing on the server are no
+            # loaded values
+            loaded = field.default is None or \
+                values != field.get_default_values()
+            entry_attributes[key] = LDAPAttribute.from_values(
+                field.name, values, force_list, loaded)
+
+        entry = cls.__new__(cls)
+        object.__setattr__(entry, '_attributes', entry_attributes)
+        object.__setattr__(entry, '_dn', dn)
+        object.__setattr__(entry, '_changetype', 'modify')
+        object.__setattr__(entry, '_force_list', force_list)
+        if len(entry_attributes) == len(cls._fields):
+            object.__setattr__(entry, '_deferred', frozenset())
+        else:
+            object.__setattr__(entry, '_deferred',
+                               frozenset(cls._fields) - set(entry_attributes))
+        return entry
+
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', {}))
+        for cls in type(self).__mro__:
+            slots = cls.__dict__.get('__slots__', ())
+            if isinstance(slots, str):
+                slots = (slots,)
+            for key in slots:
+                if key in ('__dict__', '__weakref__'):
+                    continue
+                try:
+                    state[key] = object.__getattribute__(self, key)
+                except AttributeError:
+                    pass
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            object.__setattr__(self, key, value)
+
     @property
     def dn(self):
         if self._dn is None:
@@ -87,15 +249,22 @@ class LDAPEntry(object, metaclass=LDAPEntryMeta):
         if value is None:
             value = []
         if not self._attributes.get(attr):
-            self._attributes[attr] = LDAPAttribute(self._get_field_name(attr))
+            self._attributes[attr] = LDAPAttribute(self._get_field_name(attr),
+                                                   self._force_list)
         self._attributes[attr].value = value
         if init:
-            self._attributes[attr].__dict__['changetype'] = None
+            self._attributes[attr].reset_changetype()
+        elif attr in self._deferred:
+            # The server values are unknown, replace them
+            self._attributes[attr].replace()
+            self._deferred = self._deferred - {attr}
 
     def _isstored(self, attr):
         return self._attributes.get(attr)
 
     def _get_attr(self, attr):
+        if attr in self._deferred:
+            self.load(attr)
         if self._isstored(attr):
             return self._attributes[attr].value
         return None
@@ -111,6 +280,88 @@ class LDAPEntry(object, metaclass=LDAPEntryMeta):
         else:
             return super(LDAPModel, self).__setattr__(key, value)
 
+    def get_deferred_fields(self):
+        '''Return the keys of the fields not loaded from the server'''
+        return self._deferred
+
+    def load(self, *fields):
+        '''Load deferred fields with one BASE search
+
+        Deferred fields are loaded on first access, to load several of
+        them with one search, load them before.
+
+        Args:
+            *fields: Keys of the fields to load, defaults to all
+                deferred fields.
+        '''
+        fields = [key for key in fields or self._deferred
+                  if key in self._deferred]
+        if not fields:
+            return
+
+        query = type(self).query.only(*fields)
+        query.base_dn = self.dn
+        query.sub_tree = BASE
+        for response in query.get_search_response():
+            loaded = self.from_search_response(response, self._force_list,
+                                               query.fields)
+            break
+        else:
+            # The entry is gone, use the defaults
+            loaded = self.from_attributes_dict(
+                self.dn,
+                dict((key, self._fields[key].get_default_values())
+                     for key in fields),
+                self._force_list
+            )
+
+        for key in fields:
+            self._attributes[key] = loaded._attributes[key]
+        self._deferred = self._deferred.difference(fields)
+
+    def iter_values(self, key):
+        '''Yield the values of a field
+
+        The values of a deferred ranged field are streamed range by
+        range from the server without loading them into the entry.
+
+        Args:
+            key (str): Key of the field
+        '''
+        field = self._get_field(key)
+        if field is None:
+            raise LDAPAttributeError('attribute not found')
+        if key in self._deferred and not field.ranged:
+            self.load(key)
+        if key not in self._deferred:
+            for value in list(self._attributes[key].values):
+                yield value
+            return
+
+        query = type(self).query
+        query.base_dn = self.dn
+        query.sub_tree = BASE
+        conn = self.connection.connection
+        attribute = field.name
+        while attribute is not None:
+            # Request one range at a time instead of letting ldap3
+            # collect all ranges
+            auto_range = conn.auto_range
+            empty_attributes = conn.empty_attributes
+            conn.auto_range = conn.empty_attributes = False
+            try:
+                responses = list(
+                    query.get_search_response(attributes=[attribute]))
+            finally:
+                conn.auto_range = auto_range
+                conn.empty_attributes = empty_attributes
+            if not responses:
+                return
+            values, attribute = _get_range(responses[0]['attributes'],
+                                           field.name)
+            for value in values:
+                yield value
+
     def get_attributes_dict(self):
         return dict((attribute_key, attribute_value.values) for (attribute_key,
                     attribute_value) in self._attributes.items())
@@ -125,8 +376,10 @@ class LDAPEntry(object, metaclass=LDAPEntryMeta):
     def get_entry_modify_dict(self, attr_dict):
         modify_dict = dict()
         for attribute_key in attr_dict.keys():
-            if self._attributes[attribute_key].changetype is not None:
-                changes = self._attributes[attribute_key].get_changes_tuple()
+            changes = self._attributes[attribute_key].get_changes()
+            if len(changes) == 1:
+                changes = changes[0]
+            if changes:
                 modify_dict.update({self._get_field_name(attribute_key): changes})
         return modify_dict
 
@@ -134,23 +387,62 @@ class LDAPEntry(object, metaclass=LDAPEntryMeta):
     def connection(self):
         return current_app.extensions.get('ldap_conn')
 
-    def delete(self):
-        '''Delete this entry from LDAP server'''
-        return self.connection.connection.delete(self.dn)
-
-    def save(self):
-        '''Save the current instance'''
+    def get_save_request(self):
+        '''Return the connection operation and its arguments to save
+        the current instance or ``None`` for an unknown changetype.
+        '''
         attrs = self.get_attributes_dict()
         if self._changetype == 'add':
             changes = self.get_entry_add_dict(attrs)
-            return self.connection.connection.add(self.dn,
-                                                  self.object_classes,
-                                                  changes)
+            return 'add', (self.dn, self.object_classes, changes)
         elif self._changetype == 'modify':
             changes = self.get_entry_modify_dict(attrs)
-            return self.connection.connection.modify(self.dn, changes)
+            return 'modify', (self.dn, changes)
+        return None
+
+    def _reset_changes(self):
+        '''Mark the current values as saved on the server'''
+        for attr in self._attributes.values():
+            attr.reset_changetype()
+        self._changetype = 'modify'
+
+    def _after_write(self, deleted=False):
+        '''Drop cached state of this entry after it was written'''
+        self.connection.query_cache.invalidate(self.dn)
+        identity_map = self.connection.identity_map
+        if deleted and identity_map is not None:
+            identity_map.pop((type(self), normalize_dn(self.dn)), None)
+
+    def delete(self):
+        '''Delete this entry from LDAP server'''
+        result = self.connection.connection.delete(self.dn)
+        self._after_write(deleted=True)
+        return result
 
-        return False
+    def save(self):
+        '''Save the current instance'''
+        request = self.get_save_request()
+        if request is None:
+            return False
+
+        operation, args = request
+        result = getattr(self.connection.connection, operation)(*args)
+        if result:
+            # Later changes are saved relative to the saved values
+            self._reset_changes()
+        self._after_write()
+        return result
+
+    async def delete_async(self):
+        '''Awaitable version of :meth:`delete`'''
+        result = await self.connection.run_async(self.delete)
+        # The delete ran with the identity map of another app context
+        self._after_write(deleted=True)
+        return result
+
+    async def save_async(self):
+        '''Awaitable version of :meth:`save`'''
+        return await self.connection.run_async(self.save)
 
     def authenticate(self, password):
         '''Authenticate a user with an LDAPModel class
@@ -161,7 +453,12 @@ class LDAPEntry(object, metaclass=LDAPEntryMeta):
         '''
         return self.connection.authenticate(self.dn, password)
 
-    def to_json(self, indent=2, sort=True, str_values=False):
+    async def authenticate_async(self, password):
+        '''Awaitable version of :meth:`authenticate`'''
+        return await self.connection.authenticate_async(self.dn, password)
+
+    def to_dict(self, str_values=False):
+        '''Return the DN and the attributes of the entry as dict'''
         json_entry = dict()
         json_entry['dn'] = self.dn
 
@@ -175,6 +472,11 @@ class LDAPEntry(object, metaclass=LDAPEntryMeta):
         else:
             json_entry['attributes'] = self.get_attributes_dict()
 
+        return json_entry
+
+    def to_json(self, indent=2, sort=True, str_values=False):
+        json_entry = self.to_dict(str_values)
+
         if str == bytes:
             check_json_dict(json_entry)
 
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+from ldap3.utils.conv import escape_filter_chars
+
+from .cache import LRUCache
+
+
+__all__ = ('Expression', 'Comparison', 'And', 'Or', 'Not')
+
+
+# Filter templates by expression shape
+_templates = LRUCache(maxsize=1024)
+
+
+def _escape(value):
+    if isinstance(value, bool):
+        value = 'TRUE' if value else 'FALSE'
+    elif not isinstance(value, (str, bytes)):
+        value = str(value)
+    return escape_filter_chars(value)
+
+
+class Expression(object):
+    '''Base class of filter expressions built from model fields
+
+    Expressions can be combined with ``&``, ``|`` and ``~`` and are
+    compiled to RFC 4515 filters. The filter template of an expression
+    depends only on its shape, the attributes and operators used, and
+    is cached, so only the escaped values are filled in for expressions
+    of a known shape.
+    '''
+
+    shape = None
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def get_template(self):
+        '''Return the filter with ``{}`` placeholders for the values'''
+        raise NotImplementedError
+
+    def get_values(self):
+        '''Return the escaped values in the order of the placeholders'''
+        raise NotImplementedError
+
+    def compile(self):
+        '''Return the expression as LDAP filter'''
+        template = _templates.get(self.shape)
+        if template is None:
+            template = self.get_template()
+            _templates.set(self.shape, template)
+        return template.format(*self.get_values())
+
+    def __str__(self):
+        return self.compile()
+
+
+class Comparison(Expression):
+    '''Compares an attribute with a value
+
+    Args:
+        attribute (str): LDAP attribute name
+        operator (str): ``=``, ``>=``, ``<=`` or ``~=``
+        value: The value to compare with or ``None`` to test if the
+            attribute is present.
+        prefix (bool): Match any value starting with ``value``
+        suffix (bool): Match any value ending with ``value``
+    '''
+
+    def __init__(self, attribute, operator='=', value=None, prefix=False,
+                 suffix=False):
+        self.attribute = attribute
+        if value is None:
+            self.shape = ('=*', attribute)
+            self.values = ()
+        else:
+            self.shape = (operator, attribute, prefix, suffix)
+            self.values = (_escape(value),)
+
+    def get_template(self):
+        if not self.values:
+            return '({0}=*)'.format(self.attribute)
+        operator, attribute, prefix, suffix = self.shape
+        return '({0}{1}{2}{{}}{3})'.format(attribute, operator,
+                                           '*' if suffix else '',
+                                           '*' if prefix else '')
+
+    def get_values(self):
+        return self.values
+
+
+class BooleanExpression(Expression):
+
+    operator = None
+
+    def __init__(self, *expressions):
+        if not expressions:
+            raise ValueError('at least one expression is required')
+        flat = []
+        for expression in expressions:
+            if type(expression) is type(self):
+                flat.extend(expression.expressions)
+            else:
+                flat.append(expression)
+        self.expressions = flat
+        self.shape = (self.operator,) + tuple(expression.shape
+                                              for expression in flat)
+
+    def get_template(self):
+        return '({0}{1})'.format(self.operator, ''.join(
+            expression.get_template() for expression in self.expressions))
+
+    def get_values(self):
+        values = []
+        for expression in self.expressions:
+            values.extend(expression.get_values())
+        return values
+
+
+class And(BooleanExpression):
+
+    operator = '&'
+
+
+class Or(BooleanExpression):
+
+    operator = '|'
+
+
+class Not(Expression):
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.shape = ('!', expression.shape)
+
+    def __invert__(self):
+        return self.expression
+
+    def get_template(self):
+        return '(!{0})'.format(self.expression.get_template())
+
+    def get_values(self):
+        return self.expression.get_values()
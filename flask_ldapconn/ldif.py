@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+from base64 import b64decode
+
+from ldap3 import MODIFY_ADD, MODIFY_DELETE, MODIFY_REPLACE
+from ldap3.core.exceptions import LDAPLDIFError
+from ldap3.protocol.rfc2849 import operation_to_ldif
+
+
+__all__ = ('entry_to_ldif', 'parse_ldif')
+
+
+_MODIFY_OPERATIONS = {
+    'add': MODIFY_ADD,
+    'delete': MODIFY_DELETE,
+    'replace': MODIFY_REPLACE,
+}
+
+
+def entry_to_ldif(response):
+    '''Return a ``searchResEntry`` response as LDIF record
+
+    Args:
+        response (dict): A search response with ``raw_attributes``
+    '''
+    lines = [line for line in operation_to_ldif('searchResponse', [response])
+             if not line.startswith('# total number of entries')]
+    return '\n'.join(lines) + '\n'
+
+
+def _unfold(lines):
+    '''Yield ``(line number, line)`` with folded lines joined and
+    comments removed
+    '''
+    current = None
+    number = 0
+    for index, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n')
+        if line.startswith(' '):
+            if current is None:
+                raise LDAPLDIFError(
+                    'line {0}: continuation without a line'.format(index))
+            current += line[1:]
+            continue
+        if current is not None and not current.startswith('#'):
+            yield number, current
+        current = line
+        number = index
+    if current is not None and not current.startswith('#'):
+        yield number, current
+
+
+def _parse_line(number, line):
+    if line == '-':
+        return '-', None
+    name, separator, value = line.partition(':')
+    if not separator:
+        raise LDAPLDIFError('line {0}: missing ":"'.format(number))
+    if value.startswith(':'):
+        return name, b64decode(value[1:].strip())
+    if value.startswith('<'):
+        raise LDAPLDIFError('line {0}: URL values are not '
+                            'supported'.format(number))
+    return name, value.lstrip(' ')
+
+
+def _records(lines):
+    record = []
+    for number, line in _unfold(lines):
+        if line:
+            record.append((number, line))
+        elif record:
+            yield record
+            record = []
+    if record:
+        yield record
+
+
+def _get_request(record):
+    lines = [(number,) + _parse_line(number, line)
+             for number, line in record]
+    number, name, dn = lines.pop(0)
+    if name.lower() != 'dn':
+        raise LDAPLDIFError('line {0}: record must start with '
+                            'dn'.format(number))
+    if isinstance(dn, bytes):
+        dn = dn.decode('utf-8')
+
+    lines = [line for line in lines if line[1].lower() != 'control']
+    changetype = 'add'
+    if lines and lines[0][1].lower() == 'changetype':
+        changetype = lines.pop(0)[2].strip().lower()
+
+    if changetype == 'add':
+        attributes = {}
+        for number, name, value in lines:
+            attributes.setdefault(name, []).append(value)
+        return 'add', (dn, None, attributes)
+    elif changetype == 'delete':
+        return 'delete', (dn,)
+    elif changetype == 'modify':
+        changes = {}
+        modification = None
+        for number, name, value in lines:
+            if name == '-':
+                modification = None
+            elif modification is None:
+                if name.lower() not in _MODIFY_OPERATIONS:
+                    raise LDAPLDIFError('line {0}: unknown modification '
+                                        '{1}'.format(number, name))
+                modification = (_MODIFY_OPERATIONS[name.lower()], [])
+                changes.setdefault(value.strip(), []).append(modification)
+            else:
+                modification[1].append(value)
+        return 'modify', (dn, changes)
+    elif changetype in ('modrdn', 'moddn'):
+        values = dict((name.lower(), value) for number, name, value in lines)
+        return 'modify_dn', (dn, values['newrdn'],
+                             values.get('deleteoldrdn', '1').strip() == '1',
+                             values.get('newsuperior'))
+    raise LDAPLDIFError('line {0}: unknown changetype '
+                        '{1}'.format(record[0][0], changetype))
+
+
+def parse_ldif(lines):
+    '''Yield the records of an LDIF file as connection requests
+
+    Records without changetype are added. Values of ``::`` lines are
+    base64 decoded to bytes.
+
+    Args:
+        lines: Iterable of LDIF lines, e.g. a file opened in text mode
+
+    Yields:
+        tuple: ``(line number, operation, args)`` where ``operation`` is
+            the name of the ldap3 connection method to call with
+            ``args``.
+    '''
+    for record in _records(lines):
+        if record[0][1].lower().startswith('version:'):
+            record = record[1:]
+            if not record:
+                continue
+        operation, args = _get_request(record)
+        yield record[0][0], operation, args
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import g
+from flask.signals import appcontext_tearing_down
+from ldap3.core.results import RESULT_CODES
+
+from .signals import ldap_operation, check_signals_available
+
+
+__all__ = ('LDAPMetrics',)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels=''):
+        lines = []
+        cumulative = 0
+        bounds = [repr(float(bucket)) for bucket in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, self.counts):
+            cumulative += count
+            lines.append('{0}_bucket{{{1}le="{2}"}} {3}'.format(
+                name, labels + ',' if labels else '', bound, cumulative))
+        labels = '{{{0}}}'.format(labels) if labels else ''
+        lines.append('{0}_sum{1} {2!r}'.format(name, labels, self.sum))
+        lines.append('{0}_count{1} {2}'.format(name, labels, self.count))
+        return lines
+
+
+class LDAPMetrics(object):
+    '''Counters and latency histograms of the LDAP operations of an app
+
+    Receives the ``ldap_operation`` signal and counts the operations
+    per type and result, the entries returned by searches, the bytes
+    transferred and the number of operations per app context. Enable it
+    with ``LDAP_METRICS = True`` and expose :meth:`render` on a route
+    for Prometheus::
+
+        @app.route('/metrics')
+        def metrics():
+            return ldap.metrics.render(), 200, {
+                'Content-Type': 'text/plain; version=0.0.4'}
+
+    Args:
+        app (Flask): The app to collect the operations of.
+    '''
+
+    #: Upper bounds of the latency buckets in seconds
+    duration_buckets = (.001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                        1, 2.5, 5, 10)
+    #: Upper bounds of the operations per app context buckets
+    context_buckets = (0, 1, 2, 5, 10, 20, 50, 100)
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self.reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        check_signals_available('LDAPMetrics')
+        ldap_operation.connect(self._on_operation, app, weak=False)
+        appcontext_tearing_down.connect(self._on_teardown, app, weak=False)
+
+    def reset(self):
+        '''Forget all collected values'''
+        with self._lock:
+            self.operations = defaultdict(int)
+            self.entries = 0
+            self.size = defaultdict(int)
+            self.durations = {}
+            self.context_operations = Histogram(self.context_buckets)
+
+    def _on_operation(self, sender, operation, duration, result, count=None,
+                      size=None, **kwargs):
+        result = RESULT_CODES.get(result, 'unknown')
+        with self._lock:
+            self.operations[(operation, result)] += 1
+            if count is not None:
+                self.entries += count
+            if size is not None:
+                self.size[operation] += size
+            if operation not in self.durations:
+                self.durations[operation] = Histogram(self.duration_buckets)
+            self.durations[operation].observe(duration)
+        g.ldap_operation_count = g.get('ldap_operation_count', 0) + 1
+
+    def _on_teardown(self, sender, **kwargs):
+        count = g.pop('ldap_operation_count', 0)
+        with self._lock:
+            self.context_operations.observe(count)
+
+    def render(self):
+        '''Return the metrics in the Prometheus text format'''
+        lines = []
+        with self._lock:
+            lines.append('# HELP ldap_operations_total LDAP operations by '
+                         'type and result.')
+            lines.append('# TYPE ldap_operations_total counter')
+            for (operation, result), value in sorted(self.operations.items()):
+                lines.append('ldap_operations_total{{operation="{0}",'
+                             'result="{1}"}} {2}'.format(operation, result,
+                                                         value))
+
+            lines.append('# HELP ldap_operation_duration_seconds Duration of '
+                         'LDAP operations.')
+            lines.append('# TYPE ldap_operation_duration_seconds histogram')
+            for operation, histogram in sorted(self.durations.items()):
+                lines.extend(histogram.render(
+                    'ldap_operation_duration_seconds',
+                    'operation="{0}"'.format(operation)))
+
+            lines.append('# HELP ldap_search_entries_total Entries returned '
+                         'by searches.')
+            lines.append('# TYPE ldap_search_entries_total counter')
+            lines.append('ldap_search_entries_total {0}'.format(
+                self.entries))
+
+            lines.append('# HELP ldap_transferred_bytes_total Bytes sent and '
+                         'received, with LDAP_COLLECT_USAGE only.')
+            lines.append('# TYPE ldap_transferred_bytes_total counter')
+            for operation, value in sorted(self.size.items()):
+                lines.append('ldap_transferred_bytes_total{{operation="{0}"}} '
+                             '{1}'.format(operation, value))
+
+            lines.append('# HELP ldap_context_operations LDAP operations per '
+                         'app context.')
+            lines.append('# TYPE ldap_context_operations histogram')
+            lines.extend(self.context_operations.render(
+                'ldap_context_operations'))
+        return '\n'.join(lines) + '\n'
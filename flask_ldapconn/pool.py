@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import threading
+from time import monotonic
+
+from ldap3.core.exceptions import LDAPExceptionError
+
+
+__all__ = ('ConnectionPool', 'LDAPPoolTimeoutError')
+
+
+class LDAPPoolTimeoutError(LDAPExceptionError):
+    pass
+
+
+class ConnectionPool(object):
+    '''A bounded, thread-safe pool of bound ldap3 connections.
+
+    Args:
+        creator (callable): Returns a new bound connection.
+        size (int): Number of idle connections kept in the pool.
+        max_overflow (int): Number of connections allowed on top of
+            ``size`` while all pooled connections are checked out.
+        timeout (int): Seconds to wait for a connection when the pool
+            is exhausted.
+        recycle (int): Seconds a connection may stay idle in the pool
+            before it is closed instead of being reused. ``None`` keeps
+            idle connections forever.
+    '''
+
+    def __init__(self, creator, size=5, max_overflow=10, timeout=30,
+                 recycle=None):
+        self._creator = creator
+        self._size = size
+        self._max_connections = size + max_overflow
+        self._timeout = timeout
+        self._recycle = recycle
+        self._idle = []
+        self._connections = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def checkedout(self):
+        '''Number of connections currently in use'''
+        with self._cond:
+            return self._connections - len(self._idle)
+
+    def _is_stale(self, conn, checkin_time):
+        if conn.closed:
+            return True
+        if self._recycle is not None:
+            return monotonic() - checkin_time > self._recycle
+        return False
+
+    def checkout(self):
+        '''Return an idle connection or create a new one
+
+        Blocks up to ``timeout`` seconds if the pool is exhausted and
+        raises :class:`LDAPPoolTimeoutError` afterwards.
+        '''
+        deadline = None
+        stale = []
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, checkin_time = self._idle.pop()
+                    if not self._is_stale(conn, checkin_time):
+                        break
+                    self._connections -= 1
+                    stale.append(conn)
+                    continue
+                if self._connections < self._max_connections:
+                    self._connections += 1
+                    conn = None
+                    break
+                if deadline is None:
+                    deadline = monotonic() + self._timeout
+                remaining = deadline - monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    if self._idle or \
+                            self._connections < self._max_connections:
+                        continue
+                    raise LDAPPoolTimeoutError(
+                        'connection pool limit of {0} reached, timed out '
+                        'after {1} seconds'.format(self._max_connections,
+                                                   self._timeout))
+
+        for stale_conn in stale:
+            self._close(stale_conn)
+
+        if conn is not None:
+            return conn
+
+        try:
+            return self._creator()
+        except Exception:
+            with self._cond:
+                self._connections -= 1
+                self._cond.notify()
+            raise
+
+    def checkin(self, conn):
+        '''Return a connection to the pool
+
+        Closed connections and connections above the pool size are
+        unbound instead of being kept.
+        '''
+        with self._cond:
+            keep = not conn.closed and len(self._idle) < self._size
+            if keep:
+                self._idle.append((conn, monotonic()))
+            else:
+                self._connections -= 1
+            self._cond.notify()
+
+        if not keep:
+            self._close(conn)
+
+    def discard(self, conn):
+        '''Close a checked out connection without returning it'''
+        with self._cond:
+            self._connections -= 1
+            self._cond.notify()
+        self._close(conn)
+
+    def dispose(self):
+        '''Close all idle connections'''
+        with self._cond:
+            idle = self._idle
+            self._idle = []
+            self._connections -= len(idle)
+            self._cond.notify_all()
+
+        for conn, checkin_time in idle:
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.unbind()
+        except LDAPExceptionError:
+            pass
@@ -1,12 +1,86 @@
 # -*- coding: utf-8 -*-
-import sys
+import re
+import copy
+import json
+from collections import OrderedDict
+
 from flask import current_app
-from ldap3 import BASE, Reader, SUBTREE, ObjectDef
+from ldap3 import BASE, LEVEL, SUBTREE, DEREF_ALWAYS, STRING_TYPES, Reader
+from ldap3.core.exceptions import LDAPInvalidDnError, LDAPAttributeError
+from ldap3.utils.conv import escape_filter_chars, format_json
+from ldap3.utils.dn import parse_dn
+
+from .attribute import force_attribute_value_as_list
+from .cache import normalize_dn, split_rdns
+from .expression import Expression
+
+
+try:
+    import orjson
+    # Encode dates with format_json like the json module
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME
+except ImportError:
+    orjson = None
 
 
 __all__ = ('BaseQuery',)
 
 
+_json_encoder = json.JSONEncoder(ensure_ascii=False,
+                                 check_circular=False,
+                                 separators=(',', ':'),
+                                 default=format_json)
+
+
+def _dump_json(obj):
+    '''Return ``obj`` as compact UTF-8 encoded JSON'''
+    if orjson is not None:
+        return orjson.dumps(obj, default=format_json, option=_ORJSON_OPTIONS)
+    return _json_encoder.encode(obj).encode('utf-8')
+
+
+def _copy_values(entry):
+    return dict((key, list(values))
+                for key, values in entry.get_attributes_dict().items())
+
+
+_DN_ESCAPE = re.compile(r'\\([0-9a-fA-F]{2}|.)')
+
+
+def _unescape_dn_value(value):
+    '''Return the raw value of an escaped DN attribute value'''
+    raw = bytearray()
+    pos = 0
+    for match in _DN_ESCAPE.finditer(value):
+        raw += value[pos:match.start()].encode('utf-8')
+        escaped = match.group(1)
+        if len(escaped) == 2:
+            raw.append(int(escaped, 16))
+        else:
+            raw += escaped.encode('utf-8')
+        pos = match.end()
+    raw += value[pos:].encode('utf-8')
+    return raw.decode('utf-8')
+
+
+def _get_rdn_filter(dn):
+    '''Return an LDAP filter matching the RDN of ``dn`` or ``None`` if
+    the RDN can't be expressed as filter.
+    '''
+    assertions = []
+    for attr, value, separator in parse_dn(dn):
+        if value.startswith('#'):
+            # BER encoded value
+            return None
+        assertions.append('({0}={1})'.format(
+            attr, escape_filter_chars(_unescape_dn_value(value))))
+        if separator != '+':
+            break
+    if len(assertions) == 1:
+        return assertions[0]
+    return '(&{0})'.format(''.join(assertions))
+
+
 class BaseQuery(object):
 
     def __init__(self, obj):
@@ -14,28 +88,152 @@ class BaseQuery(object):
         self.query = []
         self.base_dn = obj.base_dn
         self.sub_tree = obj.sub_tree
-        self.object_def = ObjectDef(obj.object_classes)
+        self.object_def = obj.get_object_def()
         self.operational_attributes = obj.operational_attributes
         self.components_in_and = True
+        self.page_size = None
+        self.paged_criticality = False
+        self.cache_ttl = None
+        self.raw_filters = []
+        self.fields = obj._default_fields
 
     def add_abstract_attr_def(self):
-        for name, attr in self.obj._fields.items():
-            attr_def = attr.get_abstract_attr_def(name)
-            self.object_def.add_attribute(attr_def)
+        '''Deprecated
+
+        The ObjectDef is compiled once per model class, see
+        LDAPEntry.get_object_def()
+        '''
 
     def __iter__(self):
-        for entry in self.get_reader_result():
-            module = sys.modules.get(self.obj.__module__)
-            new_cls = getattr(module, self.obj.__name__)
-            ldapentry = new_cls(dn=entry.entry_dn,
-                                changetype='modify',
-                                **entry.entry_attributes_as_dict)
-            yield ldapentry
+        identity_map = None
+        if not self.page_size:
+            identity_map = current_app.extensions.get('ldap_conn').identity_map
+        if identity_map is None:
+            for entry in self._iter_entries():
+                yield entry
+            return
+
+        # Entries already loaded in this app context are returned
+        # instead of the new ones, including their unsaved changes.
+        for entry in self._iter_entries():
+            key = (self.obj, normalize_dn(entry.dn))
+            yield identity_map.setdefault(key, entry)
+
+    def _iter_entries(self):
+        from_search_response = self.obj.from_search_response
+        force_list = force_attribute_value_as_list()
+        fields = self.fields
+
+        if self.cache_ttl is None:
+            for response in self.get_search_response():
+                yield from_search_response(response, force_list, fields)
+            return
+
+        ldapc = current_app.extensions.get('ldap_conn')
+        query_cache = ldapc.query_cache
+        # Results depend on the access rights of the bound user
+        key = query_cache.make_key(self.base_dn,
+                                   ldapc.bind_identity,
+                                   self.obj.__module__,
+                                   self.obj.__qualname__,
+                                   self.get_search_scope(),
+                                   tuple(self.query),
+                                   tuple(self.raw_filters),
+                                   self.fields,
+                                   self.components_in_and,
+                                   self.operational_attributes)
+        result = query_cache.get(key)
+        if result is None:
+            entries = [from_search_response(response, force_list, fields)
+                       for response in self.get_search_response()]
+            query_cache.set(key, [(entry.dn, _copy_values(entry))
+                                  for entry in entries], self.cache_ttl)
+            for entry in entries:
+                yield entry
+        else:
+            from_attributes_dict = self.obj.from_attributes_dict
+            for dn, attributes in result:
+                yield from_attributes_dict(
+                    dn,
+                    dict((key, list(values))
+                         for key, values in attributes.items()),
+                    force_list
+                )
+
+    def get_search_scope(self):
+        if self.sub_tree == BASE:
+            return BASE
+        return SUBTREE if self.sub_tree else LEVEL
+
+    def get_search_filter(self, connection):
+        '''Return the query as LDAP filter'''
+        if self.query:
+            reader = Reader(connection=connection,
+                            object_def=self.object_def,
+                            query=','.join(self.query),
+                            base=self.base_dn,
+                            components_in_and=self.components_in_and)
+            query_filter = reader.query_filter or '(objectClass=*)'
+        else:
+            query_filter = self.obj.get_object_class_filter()
+        if self.raw_filters:
+            query_filter = '(&{0}{1})'.format(query_filter,
+                                              ''.join(self.raw_filters))
+        return query_filter
+
+    def get_attribute_names(self):
+        '''Return the LDAP attributes to request'''
+        if self.fields is None:
+            return self.obj._attribute_names
+        return [self.obj._fields[key].name for key in self.fields]
+
+    def get_search_response(self, attributes=None):
+        '''Execute the query and return the ``searchResEntry``
+        responses
+
+        Paged queries return a generator which requests the next page
+        when the entries of the current page are consumed.
+
+        Args:
+            attributes (list): LDAP attributes to request instead of the
+                attributes of the selected fields
+        '''
+        if attributes is None:
+            attributes = self.get_attribute_names()
+        ldapc = current_app.extensions.get('ldap_conn')
+        connection = ldapc.connection
+        search_args = dict(
+            search_base=self.base_dn,
+            search_filter=self.get_search_filter(connection),
+            search_scope=self.get_search_scope(),
+            dereference_aliases=DEREF_ALWAYS,
+            attributes=attributes,
+            get_operational_attributes=self.operational_attributes
+        )
+
+        if self.page_size:
+            response = connection.extend.standard.paged_search(
+                paged_size=self.page_size,
+                paged_criticality=self.paged_criticality,
+                generator=True,
+                **search_args
+            )
+        else:
+            with connection:
+                result = connection.search(**search_args)
+                if not connection.strategy.sync:
+                    response, result = connection.get_response(result)
+                elif connection.strategy.thread_safe:
+                    _, result, response, _ = result
+                else:
+                    response = connection.response
+
+        return (entry for entry in response
+                if entry['type'] == 'searchResEntry')
 
     def get_reader_result(self):
         query = ','.join(self.query)
         ldapc = current_app.extensions.get('ldap_conn')
-        self.add_abstract_attr_def()
         reader = Reader(connection=ldapc.connection,
                         object_def=self.object_def,
                         query=query,
@@ -44,29 +242,225 @@ class BaseQuery(object):
                         sub_tree=self.sub_tree,
                         get_operational_attributes=self.operational_attributes,
                         controls=None)
+        if self.page_size:
+            entries = reader.search_paged(self.page_size,
+                                          self.paged_criticality,
+                                          generator=True)
+            return (entry for entry in entries if entry is not None)
         reader.search()
         return reader.entries
 
     def get(self, ldap_dn):
         '''Return an LDAP entry by DN
 
+        With LDAP_IDENTITY_MAP enabled an entry already loaded in the
+        current app context is returned without a search.
+
         Args:
             ldap_dn (str): LDAP DN
         '''
+        identity_map = current_app.extensions.get('ldap_conn').identity_map
+        if identity_map is not None:
+            entry = identity_map.get((self.obj, normalize_dn(ldap_dn)))
+            if entry is not None:
+                return entry
         self.base_dn = ldap_dn
         self.sub_tree = BASE
         return self.first()
 
+    def get_many(self, ldap_dns, chunk_size=100):
+        '''Return the LDAP entries of many DNs
+
+        Instead of one search per DN, the DNs are grouped by their
+        parent entry and each group is fetched with one search for an
+        OR filter of their RDNs, ``chunk_size`` DNs at a time.
+
+        Args:
+            ldap_dns (list): LDAP DNs, a single DN is fetched as a list
+                of one DN
+            chunk_size (int): Maximum number of DNs per search
+
+        Returns:
+            list: The entries in the order of ``ldap_dns``, ``None`` for
+                DNs which were not found.
+        '''
+        # The value of an attribute with one value is no list
+        if isinstance(ldap_dns, STRING_TYPES):
+            ldap_dns = [ldap_dns]
+        else:
+            ldap_dns = list(ldap_dns)
+        identity_map = current_app.extensions.get('ldap_conn').identity_map
+        entries = {}
+        single = []
+        parents = OrderedDict()
+        for ldap_dn in ldap_dns:
+            key = normalize_dn(ldap_dn)
+            if key in entries:
+                continue
+            entries[key] = None
+            if identity_map is not None:
+                entry = identity_map.get((self.obj, key))
+                if entry is not None:
+                    entries[key] = entry
+                    continue
+            try:
+                rdn_filter = _get_rdn_filter(ldap_dn)
+            except LDAPInvalidDnError:
+                rdn_filter = None
+            rdns = split_rdns(key)
+            if rdn_filter is None or len(rdns) < 2:
+                single.append((key, ldap_dn))
+                continue
+            parent = ','.join(rdns[1:])
+            parents.setdefault(parent, []).append(rdn_filter)
+
+        for parent, rdn_filters in parents.items():
+            for index in range(0, len(rdn_filters), chunk_size):
+                chunk = rdn_filters[index:index + chunk_size]
+                query = self._clone()
+                query.base_dn = parent
+                query.sub_tree = False
+                query.raw_filters.append('(|{0})'.format(''.join(chunk)))
+                for entry in query:
+                    key = normalize_dn(entry.dn)
+                    # Other entries may share a value of the RDN
+                    if key in entries:
+                        entries[key] = entry
+
+        for key, ldap_dn in single:
+            entries[key] = self._clone().get(ldap_dn)
+
+        return [entries[normalize_dn(ldap_dn)] for ldap_dn in ldap_dns]
+
+    def _clone(self):
+        query = copy.copy(self)
+        query.query = list(self.query)
+        query.raw_filters = list(self.raw_filters)
+        return query
+
     def filter(self, *query_filter):
         '''Set the query filter to perform the query with
 
+        Filter expressions are always combined with AND, even with
+        ``all(components_in_and=False)``.
+
         Args:
-            *query_filter: Simplified Query Language filter
+            *query_filter: Simplified Query Language filter or filter
+                expressions built from the model fields like
+                ``User.email == 'fry@planetexpress.com'``
         '''
         for query in query_filter:
-            self.query.append(query)
+            if isinstance(query, Expression):
+                self.raw_filters.append(query.compile())
+            else:
+                self.query.append(query)
+        return self
+
+    def cache(self, ttl=60):
+        '''Cache the results of this query
+
+        Results are stored in the query cache of the extension and
+        reused by equal queries until ``ttl`` expires or an entry below
+        the query base is saved or deleted.
+
+        Args:
+            ttl (int): Seconds to keep the results
+        '''
+        self.cache_ttl = ttl
+        return self
+
+    def _check_fields(self, fields):
+        for key in fields:
+            if key not in self.obj._fields:
+                raise LDAPAttributeError('attribute not found')
+
+    def only(self, *fields):
+        '''Only request the given fields from the server, the other
+        fields of the entries are deferred
+
+        Args:
+            *fields: Keys of the fields to load
+        '''
+        self._check_fields(fields)
+        self.fields = tuple(sorted(set(fields)))
+        return self
+
+    def defer(self, *fields):
+        '''Don't request the given fields from the server
+
+        Args:
+            *fields: Keys of the fields to defer
+        '''
+        self._check_fields(fields)
+        if self.fields is None:
+            loaded = self.obj._fields
+        else:
+            loaded = self.fields
+        self.fields = tuple(sorted(set(loaded) - set(fields)))
+        return self
+
+    def paged(self, page_size=1000, criticality=False):
+        '''Fetch the results page by page with the Simple Paged Results
+        control
+
+        Iterating the query yields the entries of a page before the next
+        page is requested, so large results are never held in memory.
+
+        Args:
+            page_size (int): Number of entries requested per page
+            criticality (bool): Fail if the server does not support
+                paged results
+        '''
+        self.page_size = page_size
+        self.paged_criticality = criticality
         return self
 
+    def _stream(self, start, separator, line_end, end, str_values,
+                buffer_size):
+        chunks = [start]
+        size = len(start)
+        prefix = b''
+        for entry in iter(self):
+            chunk = prefix + _dump_json(entry.to_dict(str_values)) + line_end
+            prefix = separator
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= buffer_size:
+                yield b''.join(chunks)
+                chunks = []
+                size = 0
+        chunks.append(end)
+        yield b''.join(chunks)
+
+    def stream_json(self, str_values=False, buffer_size=65536):
+        '''Yield the results as UTF-8 encoded JSON array in chunks
+
+        The entries are encoded one by one as they are loaded, combine
+        with :meth:`paged` to export large results with a Flask
+        streaming response::
+
+            return Response(User.query.paged().stream_json(),
+                            mimetype='application/json')
+
+        The output is compact JSON like ``LDAPEntry.to_dict()``. If
+        ``orjson`` is installed, it is used to encode the entries.
+
+        Args:
+            str_values (bool): Single values as string instead of list,
+                see ``LDAPEntry.to_json()``
+            buffer_size (int): Minimum size of the yielded chunks in
+                bytes
+        '''
+        return self._stream(b'[', b',', b'', b']', str_values, buffer_size)
+
+    def stream_ndjson(self, str_values=False, buffer_size=65536):
+        '''Yield the results as UTF-8 encoded newline delimited JSON in
+        chunks, one entry per line
+
+        See :meth:`stream_json`.
+        '''
+        return self._stream(b'', b'', b'\n', b'', str_values, buffer_size)
+
     def first(self):
         '''Execute the query and return the first result
 
@@ -80,3 +474,23 @@ class BaseQuery(object):
         '''Return all of the results of a query in a list'''
         self.components_in_and = components_in_and
         return [obj for obj in iter(self)]
+
+    async def get_async(self, ldap_dn):
+        '''Awaitable version of :meth:`get`'''
+        ldapc = current_app.extensions.get('ldap_conn')
+        return await ldapc.run_async(self.get, ldap_dn)
+
+    async def get_many_async(self, ldap_dns, chunk_size=100):
+        '''Awaitable version of :meth:`get_many`'''
+        ldapc = current_app.extensions.get('ldap_conn')
+        return await ldapc.run_async(self.get_many, ldap_dns, chunk_size)
+
+    async def first_async(self):
+        '''Awaitable version of :meth:`first`'''
+        ldapc = current_app.extensions.get('ldap_conn')
+        return await ldapc.run_async(self.first)
+
+    async def all_async(self, components_in_and=True):
+        '''Awaitable version of :meth:`all`'''
+        ldapc = current_app.extensions.get('ldap_conn')
+        return await ldapc.run_async(self.all, components_in_and)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import re
+from collections import Counter, OrderedDict, deque
+
+from flask import g, request, has_request_context
+from flask.signals import appcontext_tearing_down
+from ldap3 import BASE
+
+from .signals import ldap_operation, check_signals_available
+
+
+__all__ = ('LDAPQueryLog', 'get_search_shape')
+
+
+_FILTER_VALUE = re.compile(r'(\([^()=<>~]+[<>~]?=)([^()]*)\)')
+_RDN_VALUE = re.compile(r'^(\s*[^=,]+=)(?:[^,\\]|\\.)*')
+
+
+def _replace_value(match):
+    # Presence tests and the object classes of models are no values
+    if match.group(2) == '*' or \
+            match.group(1)[1:].lower().startswith('objectclass'):
+        return match.group(0)
+    return match.group(1) + '?)'
+
+
+def get_search_shape(dn, search_filter, scope):
+    '''Return a search with its values replaced by ``?``
+
+    Searches of the same shape only differ in the values of their
+    filter and, for BASE searches, in the RDN value of their base.
+    '''
+    if scope == BASE:
+        dn = _RDN_VALUE.sub(r'\1?', dn)
+    return dn, _FILTER_VALUE.sub(_replace_value, search_filter), scope
+
+
+class LDAPQueryLog(object):
+    '''Logs slow and repeated LDAP operations of an app context
+
+    While the app context is active, operations which took at least
+    ``slow`` seconds and the number of searches of each shape (see
+    :func:`get_search_shape`) are recorded in ``g``, with the first
+    search of every shape as an example. When the app context ends,
+    the slow operations are logged as warnings to the app logger, as
+    well as the shapes searched at least ``repeated`` times, e.g. by
+    ``query.get()`` in a loop. Other operations are not kept, so long
+    app contexts like ``flask ldap import`` don't fill the memory.
+
+    Args:
+        app (Flask): The app to log the operations of.
+        slow (float): Duration in seconds to log an operation as slow
+            or ``None``
+        repeated (int): Number of searches of the same shape to log or
+            ``None``
+        max_operations (int): Number of the last operations to keep in
+            :attr:`operations`, none by default
+    '''
+
+    def __init__(self, app=None, slow=None, repeated=None,
+                 max_operations=0):
+        self.slow = slow
+        self.repeated = repeated
+        self.max_operations = max_operations
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        check_signals_available('LDAPQueryLog')
+        ldap_operation.connect(self._on_operation, app, weak=False)
+        appcontext_tearing_down.connect(self._on_teardown, app, weak=False)
+
+    @property
+    def operations(self):
+        '''The last ``max_operations`` operations of the current app
+        context, each a dict of the ``ldap_operation`` signal arguments
+        '''
+        return list(g.get('ldap_query_log', {}).get('operations', ()))
+
+    def _on_operation(self, sender, **kwargs):
+        log = g.get('ldap_query_log')
+        if log is None:
+            where = None
+            if has_request_context():
+                where = '{0} {1}'.format(request.method, request.path)
+            log = g.ldap_query_log = {
+                'where': where,
+                'slow': [],
+                'searches': Counter(),
+                'examples': OrderedDict(),
+                'operations': deque(maxlen=self.max_operations)
+            }
+
+        if self.max_operations:
+            log['operations'].append(kwargs)
+        if self.slow is not None and kwargs['duration'] >= self.slow:
+            log['slow'].append(kwargs)
+        if self.repeated is not None and kwargs['operation'] == 'search':
+            shape = get_search_shape(kwargs['dn'], kwargs['search_filter'],
+                                     kwargs['scope'])
+            log['searches'][shape] += 1
+            log['examples'].setdefault(shape, kwargs)
+
+    def _on_teardown(self, sender, **kwargs):
+        log = g.pop('ldap_query_log', None)
+        if log is None:
+            return
+        where = log['where'] or 'app context'
+
+        for operation in log['slow']:
+            sender.logger.warning(
+                'Slow LDAP %s in %s took %.3fs: dn=%s filter=%s '
+                'scope=%s', operation['operation'], where,
+                operation['duration'], operation['dn'],
+                operation['search_filter'], operation['scope'])
+
+        for shape, example in log['examples'].items():
+            count = log['searches'][shape]
+            if count < self.repeated:
+                continue
+            dn, search_filter, scope = shape
+            sender.logger.warning(
+                '%d similar LDAP searches in %s: dn=%s filter=%s '
+                'scope=%s (first: dn=%s filter=%s), fetch them at once, '
+                'e.g. with query.get_many() or an OR filter', count, where,
+                dn, search_filter, scope, example['dn'],
+                example['search_filter'])
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import random
+import threading
+from timeit import default_timer
+
+from ldap3 import ServerPool, FIRST, ROUND_ROBIN, RANDOM
+from ldap3.core.exceptions import (LDAPServerPoolError,
+                                   LDAPUnknownStrategyError)
+
+
+__all__ = ('LDAPServerPool', 'LATENCY')
+
+
+# Prefer the servers with the lowest recent response times
+LATENCY = 'LATENCY'
+
+STRATEGIES = (FIRST, ROUND_ROBIN, RANDOM, LATENCY)
+
+
+class LDAPServerPool(ServerPool):
+    '''Server pool with health and latency tracking
+
+    A server which fails with a communication error is ejected from the
+    pool for ``eject_time`` seconds. Ejected servers are only used if
+    no other server is left. The ``FIRST``, ``ROUND_ROBIN`` and
+    ``RANDOM`` strategies select among the other servers as in ldap3.
+    ``LATENCY`` keeps a moving average of the response times of each
+    server and uses the faster of two random servers, so the load is
+    spread across all servers with a preference for the fast ones. A
+    share of ``explore`` of the connections uses a random server to
+    keep the response times of the slow servers up to date.
+
+    Unlike ``ldap3.ServerPool`` the state is shared by all connections
+    and nothing is stored per connection, and servers are not probed
+    before use.
+
+    Args:
+        servers (list): ``ldap3.Server`` objects
+        pool_strategy (str): ``FIRST``, ``ROUND_ROBIN``, ``RANDOM`` or
+            ``LATENCY``
+        eject_time (float): Seconds a failed server is not used
+        decay (float): Weight of a new response time in the moving
+            average
+        explore (float): Share of random servers with ``LATENCY``
+    '''
+
+    def __init__(self, servers, pool_strategy=ROUND_ROBIN, eject_time=30,
+                 decay=0.2, explore=0.05):
+        if pool_strategy not in STRATEGIES:
+            raise LDAPUnknownStrategyError('unknown pooling strategy')
+        super(LDAPServerPool, self).__init__(servers, ROUND_ROBIN,
+                                             active=False)
+        self.strategy = pool_strategy
+        self.eject_time = eject_time
+        self.decay = decay
+        self.explore = explore
+        self.latency = {}
+        self.ejected = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def initialize(self, connection):
+        pass
+
+    def get_current_server(self, connection):
+        # Only a placeholder until the connection is opened
+        return self.servers[0] if self.servers else None
+
+    def get_available_servers(self):
+        '''Return the servers which are not ejected'''
+        now = default_timer()
+        available = [server for server in self.servers
+                     if self.ejected.get(id(server), 0) <= now]
+        if not available and self.servers:
+            # Try the server ejected first again when all are down
+            available = [min(self.servers,
+                             key=lambda server: self.ejected[id(server)])]
+        return available
+
+    def get_server(self, connection):
+        available = self.get_available_servers()
+        if not available:
+            raise LDAPServerPoolError('no servers in server pool')
+
+        if self.strategy == FIRST:
+            return available[0]
+        elif self.strategy == RANDOM:
+            return random.choice(available)
+        elif self.strategy == ROUND_ROBIN:
+            with self._lock:
+                self._next += 1
+                return available[self._next % len(available)]
+
+        if random.random() < self.explore:
+            return random.choice(available)
+        candidates = random.sample(available, min(2, len(available)))
+        return min(candidates,
+                   key=lambda server: self.latency.get(id(server), 0))
+
+    def report_latency(self, server, duration):
+        '''Add the response time of an operation to the average'''
+        average = self.latency.get(id(server))
+        if average is None:
+            self.latency[id(server)] = duration
+        else:
+            self.latency[id(server)] = average + \
+                self.decay * (duration - average)
+
+    def report_failure(self, server):
+        '''Eject a server after a communication error'''
+        self.ejected[id(server)] = default_timer() + self.eject_time
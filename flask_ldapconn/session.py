@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import re
+from timeit import default_timer
+from collections import Counter, deque
+
+from ldap3.core.exceptions import LDAPOperationResult
+
+from .signals import is_observed, send_operation
+
+
+__all__ = ('LDAPSession', 'pipeline')
+
+
+_RDN_SEPARATOR = re.compile(r'(?<!\\)\s*,\s*')
+
+
+def _get_result(exception):
+    return {'result': exception.result,
+            'description': exception.description,
+            'message': exception.message,
+            'dn': exception.dn,
+            'type': exception.type}
+
+
+def _get_dn_key(dn):
+    return tuple(_RDN_SEPARATOR.split(dn.strip().lower()))
+
+
+def _release(counter, key):
+    counter[key] -= 1
+    if not counter[key]:
+        del counter[key]
+
+
+def _send(conn, operation, args):
+    try:
+        return getattr(conn, operation)(*args)
+    except LDAPOperationResult as e:
+        return _get_result(e)
+
+
+def _receive(conn, operation, dn, sent, start):
+    if isinstance(sent, dict):
+        result = sent
+    else:
+        try:
+            _, result = conn.get_response(sent)
+        except LDAPOperationResult as e:
+            result = _get_result(e)
+    if start is not None:
+        send_operation(operation, dn, default_timer() - start,
+                       result['result'])
+    return result
+
+
+def pipeline(conn, requests, window=None):
+    '''Send requests without waiting for the previous responses.
+
+    Up to ``window`` requests are outstanding at a time. A request for
+    an entry waits for the outstanding requests of the entry, its
+    parents and its descendants to finish first, so an entry is not
+    modified before it has been added, a child is not added before its
+    parent and a parent is not deleted before its children.
+
+    The ``ldap_operation`` signal is sent for every request with the
+    time from sending the request to reading its response.
+
+    Args:
+        conn (Connection): Connection with an asynchronous strategy
+        requests: Iterable of ``(item, operation, args)`` tuples where
+            ``operation`` is the name of the connection method to call
+            with ``args``, the first of which is the DN.
+        window (int): Maximum number of outstanding requests or
+            ``None`` for no limit.
+
+    Yields:
+        tuple: ``(item, operation, result)`` in the order of the
+            requests, ``result`` is the ldap3 result dict.
+    '''
+    observed = is_observed()
+    outstanding = deque()
+    # Outstanding requests by DN and by the DNs of their parents
+    pending = Counter()
+    below = Counter()
+
+    def is_blocked(key):
+        if pending[key] or below[key]:
+            return True
+        return any(pending[key[index:]] for index in range(1, len(key)))
+
+    def receive():
+        item, operation, dn, key, sent, start = outstanding.popleft()
+        _release(pending, key)
+        for index in range(1, len(key)):
+            _release(below, key[index:])
+        return item, operation, _receive(conn, operation, dn, sent, start)
+
+    for item, operation, args in requests:
+        key = _get_dn_key(args[0])
+        while outstanding and ((window and len(outstanding) >= window) or
+                               is_blocked(key)):
+            yield receive()
+        start = default_timer() if observed else None
+        outstanding.append((item, operation, args[0], key,
+                            _send(conn, operation, args), start))
+        pending[key] += 1
+        for index in range(1, len(key)):
+            below[key[index:]] += 1
+    while outstanding:
+        yield receive()
+
+
+class LDAPSession(object):
+    '''Collects entries to save or delete and writes them in one go.
+
+    On flush the requests are sent over a single connection with an
+    asynchronous strategy without waiting for the previous responses,
+    see :func:`pipeline`, instead of waiting one round-trip each. The
+    entries are written in the order they were added, except that a
+    request waits for the outstanding requests of its parents and
+    descendants, so a subtree can be added top-down and deleted
+    bottom-up in one session.
+
+    Use it as context manager to flush when the block ends::
+
+        with ldap.session() as session:
+            for account in accounts:
+                session.add(User(**account))
+        failed = [entry for entry, result in session.results
+                  if result['result'] != 0]
+
+    Args:
+        ldapc (LDAPConn): The extension to connect with.
+    '''
+
+    def __init__(self, ldapc):
+        self.ldapc = ldapc
+        self.pending = []
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.rollback()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, entry):
+        '''Save a new or modified entry on the next flush'''
+        self.pending.append(('save', entry))
+
+    def delete(self, entry):
+        '''Delete an entry on the next flush'''
+        self.pending.append(('delete', entry))
+
+    def rollback(self):
+        '''Forget all pending operations'''
+        self.pending = []
+
+    def _get_requests(self):
+        requests = []
+        for action, entry in self.pending:
+            if action == 'delete':
+                requests.append((entry, 'delete', (entry.dn,)))
+                continue
+            request = entry.get_save_request()
+            if request is None:
+                continue
+            operation, args = request
+            # Nothing to send for an unchanged entry
+            if operation == 'modify' and not args[1]:
+                continue
+            requests.append((entry, operation, args))
+        return requests
+
+    def flush(self):
+        '''Send all pending operations and wait for their results.
+
+        Entries without changes are skipped.
+
+        Returns:
+            list: ``(entry, result)`` tuples in the order the entries
+                were added, ``result`` is the ldap3 result dict of the
+                operation.
+        '''
+        requests = self._get_requests()
+        self.pending = []
+        if not requests:
+            return []
+
+        conn = self.ldapc.connect_session()
+        try:
+            results = []
+            for entry, operation, result in pipeline(conn, requests):
+                if operation != 'delete' and result['result'] == 0:
+                    entry._reset_changes()
+                entry._after_write(deleted=operation == 'delete')
+                results.append((entry, result))
+        finally:
+            conn.unbind()
+
+        self.results.extend(results)
+        return results
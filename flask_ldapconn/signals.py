@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from flask import current_app, has_app_context
+from flask.signals import Namespace
+
+try:
+    from flask.signals import signals_available
+except ImportError:
+    # Flask 2.3 and later depend on blinker
+    signals_available = True
+
+
+__all__ = ('ldap_operation',)
+
+
+_signals = Namespace()
+
+#: Sent after each LDAP operation with the app as sender. Receivers get
+#: the keyword arguments ``operation`` (e.g. ``'search'``), ``dn`` (the
+#: search base or entry DN), ``search_filter``, ``scope``, ``count``
+#: (entries returned by a search), ``size`` (bytes sent and received,
+#: only with ``LDAP_COLLECT_USAGE``), ``result`` (the LDAP result code)
+#: and ``duration`` in seconds. Unknown values are ``None``.
+ldap_operation = _signals.signal('ldap-operation')
+
+
+def is_observed():
+    '''Return whether anybody receives the operation signal'''
+    return signals_available and bool(ldap_operation.receivers) and \
+        has_app_context()
+
+
+def check_signals_available(feature):
+    '''Raise a RuntimeError if ``feature`` can't receive signals
+    because blinker is not installed
+    '''
+    if not signals_available:
+        raise RuntimeError('{0} requires signals, install the blinker '
+                           'library'.format(feature))
+
+
+def send_operation(operation, dn, duration, result, search_filter=None,
+                   scope=None, count=None, size=None):
+    ldap_operation.send(current_app._get_current_object(),
+                        operation=operation,
+                        dn=dn,
+                        search_filter=search_filter,
+                        scope=scope,
+                        count=count,
+                        size=size,
+                        result=result,
+                        duration=duration)
@@ -2,20 +2,38 @@
 # -*- coding: utf-8 -*-
 import sys
 import ssl
+import copy
 import json
 import time
+import pickle
+import datetime
+import asyncio
 import random
 import string
+import tempfile
 import unittest
 import flask
 
-from ldap3 import SUBTREE, STRING_TYPES
-from ldap3.core.exceptions import LDAPAttributeError, LDAPStartTLSError
+from ldap3 import SUBTREE, STRING_TYPES, MODIFY_ADD, MODIFY_REPLACE
+from ldap3 import MOCK_SYNC, MOCK_ASYNC, Connection, Server
+from ldap3.core.exceptions import (LDAPAttributeError, LDAPStartTLSError,
+                                   LDAPBindError, LDAPSocketOpenError,
+                                   LDAPServerPoolError, LDAPSocketSendError)
 
-from flask_ldapconn import LDAPConn
+from flask_ldapconn import LDAPConn, LAZY, LATENCY
 
 from flask_ldapconn.entry import LDAPEntry
 from flask_ldapconn.attribute import LdapField
+from flask_ldapconn.pool import ConnectionPool, LDAPPoolTimeoutError
+from flask_ldapconn.cache import LRUCache, QueryCache
+from flask_ldapconn.ldif import parse_ldif
+from flask_ldapconn.query import _dump_json
+from flask_ldapconn.metrics import LDAPMetrics
+from flask_ldapconn.querylog import LDAPQueryLog
+from flask_ldapconn.serverpool import LDAPServerPool
+from flask_ldapconn.session import pipeline
+import flask_ldapconn.signals
+from flask_ldapconn.signals import ldap_operation
 
 
 TESTING = True
@@ -75,6 +93,17 @@ class Account(User):
     password = LdapField('userPassword')
 
 
+class Person(LDAPEntry):
+    # Without instance dict
+    __slots__ = ()
+
+    base_dn = LDAP_AUTH_BASEDN
+    object_classes = ['person']
+
+    name = LdapField('cn')
+    surname = LdapField('sn')
+
+
 class LDAPConnTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -154,6 +183,145 @@ class LDAPConnModelTestCase(unittest.TestCase):
         with self.app.test_request_context():
             self.assertRaises(LDAPAttributeError, new_model)
 
+    def test_model_object_def_cached(self):
+        object_def = self.user.get_object_def()
+        self.assertTrue(self.user.query.object_def is object_def)
+        self.assertFalse(Account.get_object_def() is object_def)
+        self.assertTrue('email' in object_def)
+
+    def test_model_from_search_response(self):
+        dn = 'cn=Philip J. Fry,ou=people,dc=planetexpress,dc=com'
+        response = {
+            'dn': dn,
+            'type': 'searchResEntry',
+            'attributes': {'cn': ['Philip J. Fry'], 'uid': 'fry',
+                           'mail': []},
+            'raw_attributes': {'cn': [b'Philip J. Fry'], 'uid': [b'fry'],
+                               'mail': []},
+        }
+        with self.app.test_request_context():
+            user = self.user.from_search_response(response)
+            self.assertEqual(user.dn, dn)
+            self.assertEqual(user.userid, 'fry')
+            self.assertEqual(user.email, None)
+            self.assertEqual(user.get_entry_modify_dict(
+                user.get_attributes_dict()), {})
+
+    def test_model_from_search_response_deferred(self):
+        response = {
+            'dn': 'cn=Philip J. Fry,ou=people,dc=planetexpress,dc=com',
+            'type': 'searchResEntry',
+            'attributes': {'uid': ['fry']},
+            'raw_attributes': {'uid': [b'fry']},
+        }
+        with self.app.test_request_context():
+            user = self.user.from_search_response(response,
+                                                  fields=['userid'])
+            self.assertEqual(user.userid, 'fry')
+            self.assertEqual(user.get_deferred_fields(),
+                             set(self.user._fields) - {'userid'})
+            user.title = 'Delivery Boy'
+            self.assertFalse('title' in user.get_deferred_fields())
+            self.assertEqual(user.get_entry_modify_dict(
+                user.get_attributes_dict()),
+                {'title': ('MODIFY_REPLACE', [b'Delivery Boy'])})
+
+    def test_model_modify_delta(self):
+        emails = ['fry{}@planetexpress.com'.format(i) for i in range(4)]
+        response = {
+            'dn': 'cn=Philip J. Fry,ou=people,dc=planetexpress,dc=com',
+            'type': 'searchResEntry',
+            'attributes': {'mail': emails, 'title': ['Delivery Boy']},
+            'raw_attributes': {'mail': [email.encode('UTF-8')
+                                        for email in emails],
+                               'title': [b'Delivery Boy']},
+        }
+        with self.app.test_request_context():
+            user = self.user.from_search_response(response)
+            user.email = emails[1:] + ['fry@planetexpress.com']
+            user.title = 'Boss'
+            self.assertEqual(
+                user.get_entry_modify_dict(user.get_attributes_dict()),
+                {'mail': [('MODIFY_DELETE', [b'fry0@planetexpress.com']),
+                          ('MODIFY_ADD', [b'fry@planetexpress.com'])],
+                 'title': ('MODIFY_REPLACE', [b'Boss'])}
+            )
+            user.email = ['fry@planetexpress.com']
+            self.assertEqual(
+                user.get_entry_modify_dict(user.get_attributes_dict())['mail'],
+                ('MODIFY_REPLACE', [b'fry@planetexpress.com'])
+            )
+
+    def test_model_ranged_field_deferred(self):
+        class Group(LDAPEntry):
+            base_dn = 'ou=people,dc=planetexpress,dc=com'
+            object_classes = ['Group']
+            name = LdapField('cn')
+            member = LdapField('member', ranged=True)
+
+        self.assertEqual(Group.query.get_attribute_names(), ['cn'])
+        self.assertEqual(Group.query.only('member').get_attribute_names(),
+                         ['member'])
+        response = {
+            'dn': 'cn=ship_crew,ou=people,dc=planetexpress,dc=com',
+            'type': 'searchResEntry',
+            'attributes': {'cn': ['ship_crew']},
+            'raw_attributes': {'cn': [b'ship_crew']},
+        }
+        with self.app.test_request_context():
+            group = Group.from_search_response(
+                response, fields=Group.query.fields)
+            self.assertEqual(group.get_deferred_fields(), {'member'})
+
+    def test_model_query_only_defer(self):
+        with self.app.test_request_context():
+            user = self.user.query.only('email', 'name').filter(
+                'userid: fry').first()
+            self.assertEqual(user.name, 'Philip J. Fry')
+            self.assertEqual(set(user.get_attributes_dict()),
+                             {'email', 'name'})
+            user = self.user.query.defer('email').filter(
+                'userid: fry').first()
+            self.assertEqual(user.get_deferred_fields(), {'email'})
+            self.assertRaises(LDAPAttributeError, self.user.query.only,
+                              'photo')
+
+    def test_model_load_deferred(self):
+        with self.app.test_request_context():
+            user = self.user.query.only('name').filter('userid: fry').first()
+            self.assertEqual(user.email, 'fry@planetexpress.com')
+            self.assertFalse('email' in user.get_deferred_fields())
+            user.load('userid', 'surname')
+            self.assertEqual(user.userid, 'fry')
+            self.assertEqual(user.get_deferred_fields(),
+                             {'givenname', 'title'})
+            self.assertEqual(user.get_entry_modify_dict(
+                user.get_attributes_dict()), {})
+
+    def test_model_slots(self):
+        with self.app.test_request_context():
+            user = self.user(name='Rafael Römhild')
+            self.assertFalse(hasattr(user._attributes['name'], '__dict__'))
+            user.active = 1
+            self.assertEqual(user.active, 1)
+            person = Person(name='Rafael Römhild')
+            self.assertFalse(hasattr(person, '__dict__'))
+            self.assertRaises(AttributeError, setattr, person, 'active', 1)
+
+    def test_model_pickle_copy(self):
+        with self.app.test_request_context():
+            for entry in (self.user(name='Rafael Römhild', userid='rafael'),
+                          Person(name='Rafael Römhild', surname=['R', 'S'])):
+                copies = [pickle.loads(pickle.dumps(entry)),
+                          pickle.loads(pickle.dumps(entry, 0)),
+                          copy.deepcopy(entry)]
+                for entry_copy in copies:
+                    self.assertEqual(entry_copy.dn, entry.dn)
+                    self.assertEqual(entry_copy.get_attributes_dict(),
+                                     entry.get_attributes_dict())
+                    entry_copy.name = 'Rafael'
+                    self.assertEqual(entry.name, 'Rafael Römhild')
+
     def test_model_new(self):
         with self.app.test_request_context():
             user = self.user(name='Rafael Römhild',
@@ -199,6 +367,74 @@ class LDAPConnModelTestCase(unittest.TestCase):
         matched_uids = set(expected_uids).intersection(response_uids)
         self.assertEqual(len(expected_uids), len(matched_uids))
 
+    def test_model_fetch_paged_entries(self):
+        expected_uids = ['bender', 'fry', 'hermes', 'leela', 'professor',
+                         'zoidberg']
+        query_filter = 'email: *@planetexpress.com'
+        with self.app.test_request_context():
+            entries = self.user.query.paged(2).filter(query_filter).all()
+            response_uids = [entry.userid for entry in entries]
+        matched_uids = set(expected_uids).intersection(response_uids)
+        self.assertEqual(len(expected_uids), len(matched_uids))
+
+    def test_model_paged_iter(self):
+        with self.app.test_request_context():
+            entries = iter(self.user.query.paged(1))
+            self.assertTrue(isinstance(next(entries), self.user))
+
+    def test_model_query_async(self):
+        async def fetch():
+            return await asyncio.gather(
+                self.user.query.filter('userid: fry').first_async(),
+                self.user.query.filter('userid: *').all_async()
+            )
+
+        with self.app.test_request_context():
+            loop = asyncio.new_event_loop()
+            try:
+                user, users = loop.run_until_complete(fetch())
+            finally:
+                loop.close()
+            self.assertEqual(user.userid, 'fry')
+            self.assertTrue(user.dn in [entry.dn for entry in users])
+
+    def test_model_fetch_entry_authenticate_async(self):
+        with self.app.test_request_context():
+            user = self.user.query.filter('userid: fry').first()
+            loop = asyncio.new_event_loop()
+            try:
+                self.assertTrue(loop.run_until_complete(
+                    user.authenticate_async('fry')))
+            finally:
+                loop.close()
+
+    def test_model_query_cache(self):
+        query_filter = 'userid: fry'
+        with self.app.test_request_context():
+            user = self.user.query.cache(30).filter(query_filter).first()
+            cached = self.user.query.cache(30).filter(query_filter).first()
+            self.assertFalse(user is cached)
+            self.assertEqual(user.dn, cached.dn)
+            self.assertEqual(user.email, cached.email)
+
+    def test_model_filter_expression(self):
+        with self.app.test_request_context():
+            users = self.user.query.filter(
+                (self.user.userid == 'fry') |
+                self.user.name.endswith('Leela')
+            ).all()
+            self.assertEqual(sorted(user.userid for user in users),
+                             ['fry', 'leela'])
+
+    def test_model_get_many(self):
+        dns = ['cn=Turanga Leela,ou=people,dc=planetexpress,dc=com',
+               'cn=Nobody,ou=people,dc=planetexpress,dc=com',
+               'cn=Philip J. Fry,ou=people,dc=planetexpress,dc=com']
+        with self.app.test_request_context():
+            users = self.user.query.get_many(dns, chunk_size=2)
+            self.assertEqual([user and user.userid for user in users],
+                             ['leela', None, 'fry'])
+
     def test_model_get_dn(self):
         dn = 'cn=Philip J. Fry,ou=people,dc=planetexpress,dc=com'
         with self.app.test_request_context():
@@ -230,6 +466,18 @@ class LDAPConnModelTestCase(unittest.TestCase):
             user = self.user.query.filter('userid: bender').first()
             self.assertTrue(is_json(user.to_json(str_values=True)))
 
+    def test_model_stream_json(self):
+        with self.app.test_request_context():
+            users = json.loads(b''.join(
+                self.user.query.filter('userid: *').stream_json()
+            ).decode('utf-8'))
+            lines = b''.join(self.user.query.filter(
+                'userid: *').paged(2).stream_ndjson(buffer_size=1))
+            self.assertEqual([json.loads(line.decode('utf-8'))
+                              for line in lines.splitlines()], users)
+            user = self.user.query.filter('userid: fry').first()
+            self.assertTrue(user.to_dict() in users)
+
     def test_model_iter(self):
         with self.app.test_request_context():
             user = self.user.query.filter('userid: bender').first()
@@ -263,6 +511,12 @@ class LDAPConnModelTestCase(unittest.TestCase):
             user = self.user.query.filter('userid: fry').first()
             self.assertTrue(isinstance(user.userid, list))
 
+    def test_model_attribute_value_outside_app_context(self):
+        self.app.config['FORCE_ATTRIBUTE_VALUE_AS_LIST'] = True
+        with self.app.test_request_context():
+            user = self.user(userid='fry')
+        self.assertEqual(user.userid, ['fry'])
+
     def test_model_attribute_iter(self):
         with self.app.test_request_context():
             user = self.user.query.filter('userid: professor').first()
@@ -298,6 +552,16 @@ class LDAPConnModelTestCase(unittest.TestCase):
             self.assertEqual(user.title, 'SysAdmin')
             self.assertTrue('it@planetexpress.co' in user.email)
 
+    def test_model_operation_modify_cached(self):
+        uid = 'rafael-{}'.format(UID_SUFFIX)
+        query_filter = 'userid: {}'.format(uid)
+        with self.app.test_request_context():
+            mod_user = self.user.query.cache().filter(query_filter).first()
+            mod_user.title = 'Delivery Boy'
+            self.assertTrue(mod_user.save())
+            user = self.user.query.cache().filter(query_filter).first()
+            self.assertEqual(user.title, 'Delivery Boy')
+
     def test_model_operation_remove(self):
         uid = 'rafael-{}'.format(UID_SUFFIX)
         query_filter = 'userid: {}'.format(uid)
@@ -308,6 +572,39 @@ class LDAPConnModelTestCase(unittest.TestCase):
             self.assertEqual(user, None)
 
 
+    def test_model_session(self):
+        uids = ['session-{}-{}'.format(i, UID_SUFFIX) for i in range(3)]
+        with self.app.test_request_context():
+            with self.ldap.session() as session:
+                for uid in uids:
+                    session.add(self.user(name=uid, userid=uid,
+                                          surname='Session'))
+            self.assertEqual([result['result'] for entry, result
+                              in session.results], [0, 0, 0])
+            users = self.user.query.filter('surname: Session').all()
+            self.assertEqual(len(users), 3)
+
+            with self.ldap.session() as session:
+                for user in users:
+                    session.delete(user)
+            self.assertEqual(
+                self.user.query.filter('surname: Session').all(), [])
+
+    def test_model_session_rollback(self):
+        uid = 'session-rollback-{}'.format(UID_SUFFIX)
+        with self.app.test_request_context():
+            try:
+                with self.ldap.session() as session:
+                    session.add(self.user(name=uid, userid=uid,
+                                          surname='Session'))
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertEqual(len(session), 0)
+            self.assertEqual(
+                self.user.query.filter('userid: {}'.format(uid)).first(),
+                None)
+
 class LDAPConnModelInheritanceTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -428,6 +725,182 @@ class LDAPConnAuthTestCase(LDAPConnTestCase):
             self.assertFalse(retval)
 
 
+class LDAPConnAuthPoolTestCase(LDAPConnAuthTestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config.from_object(__name__)
+        app.config.from_envvar('LDAP_SETTINGS', silent=True)
+        app.config['LDAP_AUTH_POOL_SIZE'] = 1
+        ldap = LDAPConn(app)
+
+        self.app = app
+        self.ldap = ldap
+
+    def test_authenticate_reuses_connection(self):
+        dn = 'cn=Philip J. Fry,ou=people,dc=planetexpress,dc=com'
+        with self.app.test_request_context():
+            self.assertFalse(self.ldap.authenticate(dn, 'testpass'))
+            self.assertTrue(self.ldap.authenticate(
+                dn, self.app.config['USER_PASSWORD']))
+            self.assertEqual(self.ldap.auth_pool.checkedout, 0)
+            self.assertEqual(len(self.ldap.auth_pool._idle), 1)
+
+
+class LDAPConnAuthCacheTestCase(LDAPConnAuthTestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config.from_object(__name__)
+        app.config.from_envvar('LDAP_SETTINGS', silent=True)
+        app.config['LDAP_AUTH_CACHE_SIZE'] = 10
+        ldap = LDAPConn(app)
+
+        self.app = app
+        self.ldap = ldap
+
+    def authenticate(self, password):
+        return self.ldap.authenticate(
+            username=self.app.config['USER_EMAIL'],
+            password=password,
+            attribute=self.app.config['LDAP_SEARCH_ATTR'],
+            base_dn=self.app.config['LDAP_AUTH_BASEDN'],
+        )
+
+    def test_authenticate_caches_dn(self):
+        with self.app.test_request_context():
+            self.assertTrue(self.authenticate(
+                self.app.config['USER_PASSWORD']))
+            self.assertEqual(len(self.ldap.dn_cache), 1)
+            self.assertTrue(self.authenticate(
+                self.app.config['USER_PASSWORD']))
+
+    def test_authenticate_invalidates_stale_dn(self):
+        with self.app.test_request_context():
+            self.authenticate(self.app.config['USER_PASSWORD'])
+            key = list(self.ldap.dn_cache._data)[0]
+            self.ldap.dn_cache.set(key, 'cn=Old Fry,' + LDAP_AUTH_BASEDN)
+            self.assertTrue(self.authenticate(
+                self.app.config['USER_PASSWORD']))
+            self.assertNotEqual(self.ldap.dn_cache.get(key),
+                                'cn=Old Fry,' + LDAP_AUTH_BASEDN)
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expires_after_ttl(self):
+        cache = LRUCache(maxsize=2, ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+
+class QueryCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = QueryCache(LRUCache())
+
+    def test_invalidate_parent_queries(self):
+        key = self.cache.make_key(LDAP_AUTH_BASEDN, 'uid: fry')
+        self.cache.set(key, ['entry'])
+        self.assertEqual(self.cache.get(key), ['entry'])
+        self.cache.invalidate('cn=Philip J. Fry,' + LDAP_AUTH_BASEDN.upper())
+        key = self.cache.make_key(LDAP_AUTH_BASEDN, 'uid: fry')
+        self.assertEqual(self.cache.get(key), None)
+
+    def test_keep_sibling_queries(self):
+        key = self.cache.make_key('ou=groups,' + LDAP_BASEDN, 'cn: staff')
+        self.cache.set(key, ['entry'])
+        self.cache.invalidate('cn=Philip J. Fry,' + LDAP_AUTH_BASEDN)
+        key = self.cache.make_key('ou=groups,' + LDAP_BASEDN, 'cn: staff')
+        self.assertEqual(self.cache.get(key), ['entry'])
+
+
+class ExpressionTestCase(unittest.TestCase):
+
+    def test_escape_values(self):
+        self.assertEqual((User.email == 'a*(b)\\').compile(),
+                         '(mail=a\\2a\\28b\\29\\5c)')
+
+    def test_combine(self):
+        expression = (User.userid.startswith('fr') & ~User.title.present()) | \
+            User.userid.in_(['bender', 'leela'])
+        self.assertEqual(
+            expression.compile(),
+            '(|(&(uid=fr*)(!(title=*)))(uid=bender)(uid=leela))'
+        )
+        self.assertEqual((User.title != None).compile(), '(title=*)')
+
+    def test_same_shape_same_template(self):
+        first = (User.userid == 'fry') & User.name.contains('Fry')
+        second = (User.userid == 'leela') & User.name.contains('Leela')
+        self.assertEqual(first.shape, second.shape)
+        self.assertEqual(second.compile(), '(&(uid=leela)(cn=*Leela*))')
+
+
+class JSONTestCase(unittest.TestCase):
+
+    def test_datetime_as_to_json(self):
+        created = datetime.datetime(2020, 1, 2, 3, 4, 5,
+                                    tzinfo=datetime.timezone.utc)
+        app = flask.Flask(__name__)
+        with app.app_context():
+            user = User(name='fry', title=[created])
+            self.assertEqual(json.loads(_dump_json(user.to_dict())),
+                             json.loads(user.to_json()))
+            self.assertEqual(json.loads(user.to_json())['attributes']['title'],
+                             ['2020-01-02 03:04:05+00:00'])
+
+
+class LDIFTestCase(unittest.TestCase):
+
+    def test_parse_records(self):
+        ldif = [
+            'version: 1\n',
+            '\n',
+            '# a comment\n',
+            'dn: uid=hermes,ou=people,dc=planetexpress,dc=com\n',
+            'objectClass: inetOrgPerson\n',
+            'cn: Hermes\n',
+            '  Conrad\n',
+            'jpegPhoto:: /wA=\n',
+            '\n',
+            'dn: uid=hermes,ou=people,dc=planetexpress,dc=com\n',
+            'changetype: modify\n',
+            'replace: title\n',
+            'title: Bureaucrat\n',
+            '-\n',
+            'add: mail\n',
+            'mail: hermes@planetexpress.com\n',
+            '-\n',
+            '\n',
+            'dn: uid=hermes,ou=people,dc=planetexpress,dc=com\n',
+            'changetype: delete\n',
+        ]
+        dn = 'uid=hermes,ou=people,dc=planetexpress,dc=com'
+        self.assertEqual(list(parse_ldif(ldif)), [
+            (4, 'add', (dn, None, {'objectClass': ['inetOrgPerson'],
+                                   'cn': ['Hermes Conrad'],
+                                   'jpegPhoto': [b'\xff\x00']})),
+            (10, 'modify', (dn, {
+                'title': [(MODIFY_REPLACE, ['Bureaucrat'])],
+                'mail': [(MODIFY_ADD, ['hermes@planetexpress.com'])],
+            })),
+            (19, 'delete', (dn,)),
+        ])
+
+
 class LDAPConnSSLTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -508,6 +981,518 @@ class LDAPConnNoTLSAnonymousTestCase(unittest.TestCase):
             self.assertEqual(conn.extend.standard.who_am_i(), None)
 
 
+class LDAPConnServerInfoTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config.from_object(__name__)
+        app.config.from_envvar('LDAP_SETTINGS', silent=True)
+        app.config['LDAP_GET_INFO'] = LAZY
+        ldap = LDAPConn(app)
+
+        self.app = app
+        self.ldap = ldap
+
+    def test_lazy_server_info(self):
+        with self.app.test_request_context():
+            self.ldap.connection
+            self.assertEqual(self.ldap.ldap_server.schema, None)
+            info, schema = self.ldap.get_server_info()
+            self.assertTrue('inetOrgPerson' in schema.object_classes)
+
+    def test_server_info_snapshot(self):
+        with tempfile.NamedTemporaryFile(suffix='.json') as snapshot:
+            runner = self.app.test_cli_runner()
+            result = runner.invoke(args=['ldap', 'snapshot', snapshot.name])
+            self.assertEqual(result.exit_code, 0)
+
+            app = flask.Flask(__name__)
+            app.config.from_object(__name__)
+            app.config.from_envvar('LDAP_SETTINGS', silent=True)
+            app.config['LDAP_SERVER_INFO_SNAPSHOT'] = snapshot.name
+            ldap = LDAPConn(app)
+
+        schema = ldap.ldap_server.schema
+        self.assertTrue('inetOrgPerson' in schema.object_classes)
+        with app.test_request_context():
+            user = User.query.filter('userid: fry').first()
+            self.assertEqual(user.userid, 'fry')
+
+
+class LDAPConnCLITestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config.from_object(__name__)
+        app.config.from_envvar('LDAP_SETTINGS', silent=True)
+        ldap = LDAPConn(app)
+
+        self.app = app
+        self.ldap = ldap
+
+    def test_export(self):
+        with tempfile.NamedTemporaryFile(suffix='.ldif') as export:
+            runner = self.app.test_cli_runner()
+            result = runner.invoke(args=['ldap', 'export', LDAP_AUTH_BASEDN,
+                                         export.name, '--filter', '(uid=fry)'])
+            self.assertEqual(result.exit_code, 0)
+            with open(export.name) as ldif:
+                records = list(parse_ldif(ldif))
+        self.assertEqual(len(records), 1)
+        operation, (dn, _, attributes) = records[0][1:]
+        self.assertEqual(attributes['mail'], [USER_EMAIL])
+
+    def test_import(self):
+        uid = 'hermes' + UID_SUFFIX
+        dn = 'uid={0},{1}'.format(uid, LDAP_AUTH_BASEDN)
+        ldif = ('dn: {0}\nobjectClass: top\nobjectClass: inetOrgPerson\n'
+                'cn: Hermes\nsn: Conrad\n\ndn: {0}\nchangetype: modify\n'
+                'add: title\ntitle: Bureaucrat\n-\n').format(dn)
+        runner = self.app.test_cli_runner()
+        with tempfile.NamedTemporaryFile('w', suffix='.ldif') as records, \
+                tempfile.NamedTemporaryFile('r', suffix='.ndjson') as journal:
+            records.write(ldif)
+            records.flush()
+            result = runner.invoke(args=['ldap', 'import', records.name])
+            self.assertEqual(result.exit_code, 0)
+            with self.app.test_request_context():
+                user = User.query.filter('userid: {0}'.format(uid)).first()
+                self.assertEqual(user.title, 'Bureaucrat')
+
+            result = runner.invoke(args=['ldap', 'import', records.name,
+                                         '--journal', journal.name])
+            self.assertEqual(result.exit_code, 1)
+            failed = [json.loads(line) for line in journal]
+            self.assertEqual(failed[0]['dn'], dn)
+            self.assertEqual(failed[0]['description'], 'entryAlreadyExists')
+
+        with self.app.test_request_context():
+            self.ldap.connection.delete(dn)
+
+
+class LDAPConnMockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config.from_object(__name__)
+        app.config['LDAP_CONNECTION_STRATEGY'] = MOCK_SYNC
+        app.config['LDAP_USE_TLS'] = False
+        ldap = LDAPConn(app)
+
+        conn = Connection(ldap.ldap_server, client_strategy=MOCK_SYNC)
+        conn.strategy.add_entry(LDAP_BINDDN, {'objectClass': 'person',
+                                              'sn': 'admin',
+                                              'userPassword': LDAP_SECRET})
+        conn.strategy.add_entry('cn=fry,' + LDAP_AUTH_BASEDN, {
+            'objectClass': ['top', 'person', 'inetOrgPerson'],
+            'cn': 'fry',
+            'sn': 'Fry',
+            'mail': USER_EMAIL,
+            'userPassword': USER_PASSWORD,
+        })
+
+        self.app = app
+        self.ldap = ldap
+
+    def test_connection_bound(self):
+        with self.app.test_request_context():
+            self.assertTrue(self.ldap.connection.bound)
+            self.assertRaises(LDAPBindError, self.ldap.connect,
+                              LDAP_BINDDN, 'wrong')
+
+    def test_authenticate(self):
+        with self.app.test_request_context():
+            self.assertTrue(self.ldap.authenticate(USER_EMAIL, USER_PASSWORD,
+                                                   'mail', LDAP_AUTH_BASEDN))
+            self.assertFalse(self.ldap.authenticate(USER_EMAIL, 'wrong',
+                                                    'mail', LDAP_AUTH_BASEDN))
+
+    def test_authenticate_cache_wrong_password(self):
+        self.ldap.dn_cache = LRUCache(maxsize=10)
+        with self.app.test_request_context():
+            self.assertTrue(self.ldap.authenticate(USER_EMAIL, USER_PASSWORD,
+                                                   'mail', LDAP_AUTH_BASEDN))
+            self.assertFalse(self.ldap.authenticate(USER_EMAIL, 'wrong',
+                                                    'mail', LDAP_AUTH_BASEDN))
+            self.assertEqual(len(self.ldap.dn_cache), 1)
+
+    def test_authenticate_pool_without_password(self):
+        dn = 'cn=fry,' + LDAP_AUTH_BASEDN
+        self.ldap.auth_pool = ConnectionPool(self.ldap._connect_service,
+                                             size=1)
+        with self.app.test_request_context():
+            self.assertTrue(self.ldap.authenticate(dn, USER_PASSWORD))
+            conn = self.ldap.auth_pool._idle[0][0]
+            self.assertEqual(conn.user, None)
+            self.assertEqual(conn.password, None)
+            self.assertFalse(self.ldap.authenticate(dn, None))
+            self.assertFalse(self.ldap.authenticate(dn, ''))
+            self.assertTrue(self.ldap.authenticate(dn, USER_PASSWORD))
+
+    def test_authenticate_pool_dropped_connection(self):
+        def drop(*args, **kwargs):
+            raise error
+
+        dn = 'cn=fry,' + LDAP_AUTH_BASEDN
+        self.ldap.auth_pool = ConnectionPool(self.ldap._connect_service,
+                                             size=1)
+        with self.app.test_request_context():
+            self.assertTrue(self.ldap.authenticate(dn, USER_PASSWORD))
+            for error in (LDAPBindError('closed'), LDAPSocketSendError()):
+                conn = self.ldap.auth_pool._idle[0][0]
+                conn.rebind = drop
+                self.assertTrue(self.ldap.authenticate(dn, USER_PASSWORD))
+                self.assertFalse(self.ldap.auth_pool._idle[0][0] is conn)
+            self.assertFalse(self.ldap.authenticate(dn, 'wrong'))
+            self.assertEqual(len(self.ldap.auth_pool._idle), 1)
+
+    def test_query_cache_per_user(self):
+        with self.app.test_request_context():
+            self.assertEqual(len(User.query.cache(ttl=60).all()), 1)
+            # Not invalidated
+            self.ldap.connection.strategy.add_entry(
+                'cn=leela,' + LDAP_AUTH_BASEDN,
+                {'objectClass': ['top', 'person', 'inetOrgPerson'],
+                 'cn': 'leela', 'sn': 'Leela'})
+            self.assertEqual(len(User.query.cache(ttl=60).all()), 1)
+        with self.app.test_request_context():
+            flask.g.ldap_conn = self.ldap.connect('cn=fry,' + LDAP_AUTH_BASEDN,
+                                                  USER_PASSWORD)
+            self.assertEqual(len(User.query.cache(ttl=60).all()), 2)
+
+    def test_get_many_single_dn(self):
+        dn = 'cn=fry,' + LDAP_AUTH_BASEDN
+        with self.app.test_request_context():
+            users = User.query.get_many(dn)
+            self.assertEqual([user.dn for user in users], [dn])
+
+    def test_session_bound_user(self):
+        dn = 'cn=fry,' + LDAP_AUTH_BASEDN
+        self.app.config['LDAP_SESSION_STRATEGY'] = MOCK_ASYNC
+        with self.app.test_request_context():
+            conn = self.ldap.connect_session()
+            self.assertEqual(conn.user, LDAP_BINDDN)
+            conn.unbind()
+            flask.g.ldap_conn = self.ldap.connect(dn, USER_PASSWORD)
+            conn = self.ldap.connect_session()
+            self.assertEqual(conn.user, dn)
+            conn.unbind()
+
+    def test_save_twice(self):
+        dn = 'cn=fry,' + LDAP_AUTH_BASEDN
+        with self.app.test_request_context():
+            user = User.query.get(dn)
+            user.email = [USER_EMAIL, 'c@x']
+            self.assertTrue(user.save())
+            user.email = [USER_EMAIL, 'c@x', 'd@x']
+            self.assertEqual(user.get_entry_modify_dict(
+                user.get_attributes_dict()),
+                {'mail': (MODIFY_ADD, [b'd@x'])})
+            self.assertTrue(user.save())
+            self.assertEqual(user.get_entry_modify_dict(
+                user.get_attributes_dict()), {})
+            self.assertEqual(sorted(User.query.get(dn).email),
+                             sorted([USER_EMAIL, 'c@x', 'd@x']))
+
+            new_user = User(name='leela', surname='Leela')
+            self.assertTrue(new_user.save())
+            new_user.title = 'Captain'
+            self.assertTrue(new_user.save())
+            self.assertEqual(User.query.get(new_user.dn).title, 'Captain')
+
+    def test_session_save_twice(self):
+        dn = 'cn=fry,' + LDAP_AUTH_BASEDN
+        self.app.config['LDAP_SESSION_STRATEGY'] = MOCK_ASYNC
+        with self.app.test_request_context():
+            user = User.query.get(dn)
+            for emails in ([USER_EMAIL, 'c@x'], [USER_EMAIL, 'c@x', 'd@x']):
+                user.email = emails
+                with self.ldap.session() as session:
+                    session.add(user)
+                self.assertEqual(session.results[-1][1]['result'], 0)
+            self.assertEqual(sorted(User.query.get(dn).email),
+                             sorted([USER_EMAIL, 'c@x', 'd@x']))
+
+    def test_delete_async_identity_map(self):
+        dn = 'cn=fry,' + LDAP_AUTH_BASEDN
+        self.app.config['LDAP_IDENTITY_MAP'] = True
+        loop = asyncio.new_event_loop()
+        try:
+            with self.app.test_request_context():
+                user = User.query.get(dn)
+                loop.run_until_complete(user.delete_async())
+                self.assertEqual(User.query.get(dn), None)
+        finally:
+            loop.close()
+
+    def test_run_async_bound_user(self):
+        def get_user():
+            return self.ldap.connection.user
+
+        dn = 'cn=fry,' + LDAP_AUTH_BASEDN
+        loop = asyncio.new_event_loop()
+        try:
+            with self.app.test_request_context():
+                self.assertEqual(loop.run_until_complete(
+                    self.ldap.run_async(get_user)), LDAP_BINDDN)
+                flask.g.ldap_conn = self.ldap.connect(dn, USER_PASSWORD)
+                self.assertEqual(loop.run_until_complete(
+                    self.ldap.run_async(get_user)), dn)
+        finally:
+            loop.close()
+
+    def test_operation_signal(self):
+        operations = []
+
+        def receive(sender, operation, count, result, **kwargs):
+            operations.append((operation, count, result))
+
+        metrics = LDAPMetrics(self.app)
+        with ldap_operation.connected_to(receive, self.app):
+            with self.app.test_request_context():
+                self.ldap.authenticate(USER_EMAIL, USER_PASSWORD, 'mail',
+                                       LDAP_AUTH_BASEDN)
+        self.assertEqual(operations, [('bind', None, 0), ('search', 1, 0),
+                                      ('bind', None, 0)])
+        text = metrics.render()
+        self.assertTrue('ldap_operations_total{operation="bind",'
+                        'result="success"} 2' in text)
+        self.assertTrue('ldap_search_entries_total 1' in text)
+        self.assertTrue('ldap_context_operations_sum 3' in text)
+
+    def test_signals_unavailable(self):
+        # Flask before 2.3 replaces the signals with a fake one without
+        # receivers when blinker is not installed
+        flask_ldapconn.signals.signals_available = False
+        flask_ldapconn.signals.ldap_operation = object()
+        try:
+            with self.app.test_request_context():
+                self.assertTrue(self.ldap.authenticate(
+                    USER_EMAIL, USER_PASSWORD, 'mail', LDAP_AUTH_BASEDN))
+            with self.assertRaises(RuntimeError):
+                LDAPMetrics(self.app)
+            with self.assertRaises(RuntimeError):
+                LDAPQueryLog(self.app)
+        finally:
+            flask_ldapconn.signals.signals_available = True
+            flask_ldapconn.signals.ldap_operation = ldap_operation
+
+    def test_query_log(self):
+        query_log = LDAPQueryLog(self.app, slow=10, repeated=3,
+                                 max_operations=2)
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            with self.app.test_request_context('/team'):
+                for name in ('fry', 'leela', 'bender'):
+                    User.query.get('cn={0},{1}'.format(name,
+                                                       LDAP_AUTH_BASEDN))
+                User.query.filter(User.userid == 'fry').first()
+                operations = query_log.operations
+                self.assertEqual(len(operations), 2)
+                self.assertTrue('(uid=fry)' in
+                                operations[-1]['search_filter'])
+                self.assertEqual(flask.g.ldap_query_log['slow'], [])
+        self.assertEqual(len(logs.output), 1)
+        self.assertTrue('3 similar LDAP searches in GET /team: '
+                        'dn=cn=?,ou=people' in logs.output[0])
+        self.assertTrue('(first: dn=cn=fry,ou=people' in logs.output[0])
+
+    def test_query_log_no_operations(self):
+        query_log = LDAPQueryLog(self.app, slow=0)
+        with self.app.test_request_context():
+            User.query.get('cn=fry,{0}'.format(LDAP_AUTH_BASEDN))
+            self.assertEqual(query_log.operations, [])
+            slow = flask.g.ldap_query_log['slow']
+            self.assertEqual([operation['operation'] for operation in slow],
+                             ['bind', 'search'])
+            self.assertEqual(flask.g.ldap_query_log['searches'], {})
+
+
+class LDAPConnPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config.from_object(__name__)
+        app.config.from_envvar('LDAP_SETTINGS', silent=True)
+        app.config['LDAP_POOL_SIZE'] = 2
+        ldap = LDAPConn(app)
+
+        self.app = app
+        self.ldap = ldap
+
+    def test_connection_reused(self):
+        with self.app.test_request_context():
+            conn = self.ldap.connection
+        with self.app.test_request_context():
+            self.assertTrue(self.ldap.connection is conn)
+            self.assertEqual(conn.extend.standard.who_am_i(),
+                             'dn:{}'.format(self.app.config['LDAP_BINDDN']))
+
+    def test_rebound_connection_discarded(self):
+        dn = 'cn=Philip J. Fry,ou=people,dc=planetexpress,dc=com'
+        with self.app.test_request_context():
+            conn = self.ldap.connection
+            conn.rebind(dn, self.app.config['USER_PASSWORD'])
+        with self.app.test_request_context():
+            self.assertFalse(self.ldap.connection is conn)
+
+
+class LDAPConnIdentityMapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config.from_object(__name__)
+        app.config.from_envvar('LDAP_SETTINGS', silent=True)
+        app.config['LDAP_IDENTITY_MAP'] = True
+        ldap = LDAPConn(app)
+
+        self.app = app
+        self.ldap = ldap
+
+    def test_same_entry_in_request(self):
+        with self.app.test_request_context():
+            user = User.query.filter('userid: fry').first()
+            self.assertTrue(User.query.get(user.dn) is user)
+            self.assertTrue(user in User.query.filter('userid: *').all())
+
+    def test_identity_map_cleared_on_teardown(self):
+        with self.app.test_request_context():
+            user = User.query.filter('userid: fry').first()
+            self.assertTrue(len(self.ldap.identity_map) > 0)
+        with self.app.test_request_context():
+            self.assertEqual(self.ldap.identity_map, {})
+            self.assertFalse(User.query.get(user.dn) is user)
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def unbind(self):
+        self.closed = True
+
+
+class FakeAsyncConnection(object):
+
+    def __init__(self):
+        self.log = []
+
+    def delete(self, dn):
+        self.log.append(('send', dn))
+        return dn
+
+    add = delete
+
+    def get_response(self, message_id):
+        self.log.append(('receive', message_id))
+        return [], {'result': 0}
+
+
+class PipelineTestCase(unittest.TestCase):
+
+    def run_pipeline(self, operation, dns):
+        conn = FakeAsyncConnection()
+        requests = [(dn, operation, (dn,)) for dn in dns]
+        results = list(pipeline(conn, requests))
+        self.assertEqual([item for item, _, _ in results], dns)
+        return conn.log
+
+    def test_delete_children_first(self):
+        log = self.run_pipeline('delete', ['cn=a,ou=x,dc=org',
+                                           'cn=b,ou=y,ou=x,dc=org',
+                                           'ou=x,dc=org'])
+        self.assertEqual(log.index(('send', 'ou=x,dc=org')), 4)
+
+    def test_add_parents_first(self):
+        log = self.run_pipeline('add', ['ou=x,dc=org', 'ou=y,dc=org',
+                                        'cn=b,ou=y,ou=x,dc=org'])
+        self.assertEqual(log[:3], [('send', 'ou=x,dc=org'),
+                                   ('send', 'ou=y,dc=org'),
+                                   ('receive', 'ou=x,dc=org')])
+
+    def test_independent_requests_outstanding(self):
+        log = self.run_pipeline('add', ['cn=a,dc=org', 'cn=b,dc=org'])
+        self.assertEqual(log[1], ('send', 'cn=b,dc=org'))
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def test_checkout_reuses_idle_connection(self):
+        pool = ConnectionPool(FakeConnection, size=1)
+        conn = pool.checkout()
+        pool.checkin(conn)
+        self.assertTrue(pool.checkout() is conn)
+
+    def test_checkin_closes_overflow(self):
+        pool = ConnectionPool(FakeConnection, size=1, max_overflow=1)
+        first = pool.checkout()
+        second = pool.checkout()
+        pool.checkin(first)
+        pool.checkin(second)
+        self.assertFalse(first.closed)
+        self.assertTrue(second.closed)
+        self.assertEqual(pool.checkedout, 0)
+
+    def test_checkout_skips_closed_connection(self):
+        pool = ConnectionPool(FakeConnection, size=1)
+        conn = pool.checkout()
+        pool.checkin(conn)
+        conn.closed = True
+        self.assertFalse(pool.checkout() is conn)
+
+    def test_checkout_timeout(self):
+        pool = ConnectionPool(FakeConnection, size=1, max_overflow=0,
+                              timeout=0.01)
+        pool.checkout()
+        self.assertRaises(LDAPPoolTimeoutError, pool.checkout)
+
+    def test_discard_frees_slot(self):
+        pool = ConnectionPool(FakeConnection, size=1, max_overflow=0,
+                              timeout=0.01)
+        conn = pool.checkout()
+        pool.discard(conn)
+        self.assertTrue(conn.closed)
+        self.assertFalse(pool.checkout() is conn)
+
+
+class LDAPServerPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [Server('ldap{0}'.format(i)) for i in range(3)]
+
+    def test_failed_server_ejected(self):
+        pool = LDAPServerPool(self.servers)
+        pool.report_failure(self.servers[1])
+        hosts = set(pool.get_server(None).host for _ in range(4))
+        self.assertEqual(hosts, set(['ldap0', 'ldap2']))
+
+    def test_round_robin(self):
+        pool = LDAPServerPool(self.servers, explore=1)
+        hosts = [pool.get_server(None).host for _ in range(300)]
+        self.assertEqual(hosts, ['ldap1', 'ldap2', 'ldap0'] * 100)
+
+    def test_latency(self):
+        pool = LDAPServerPool(self.servers, LATENCY, explore=0)
+        for server, duration in zip(self.servers, (0.05, 0.01, 0.02)):
+            pool.report_latency(server, duration)
+        hosts = set(pool.get_server(None).host for _ in range(100))
+        self.assertEqual(hosts, set(['ldap1', 'ldap2']))
+
+    def test_connect_failover(self):
+        app = flask.Flask(__name__)
+        app.config['LDAP_SERVER'] = ['localhost:1', 'localhost:2']
+        app.config['LDAP_USE_TLS'] = False
+        ldap = LDAPConn(app)
+        with app.app_context():
+            self.assertRaises(LDAPSocketOpenError, ldap.connect, 'cn=x', 'y')
+        self.assertEqual(len(ldap.ldap_server.ejected), 2)
+
+    def test_empty_server_list(self):
+        app = flask.Flask(__name__)
+        app.config['LDAP_SERVER'] = []
+        self.assertRaises(LDAPServerPoolError, LDAPConn, app)
+
+
 class LDAPConnDeprecatedTestCase(LDAPConnTestCase):
 
     def test_connection_search(self):